@@ -1,14 +1,17 @@
 # app.py (UPDATED WITH AUTOMATION, LOGIN, STAFF MANAGEMENT, SIGN-UP, PASSWORD RESET, AND WINDOWS COMPATIBILITY)
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, make_response
 import datetime
 import threading
-import time
-import smtplib
-from email.mime.text import MIMEText
+import signal
+import atexit
+import hmac
 from dotenv import load_dotenv
 import os
 import shutil
-from reminder import reminder_system
+from reminder import reminder_system, DEFAULT_TIMEZONE
+from jobs import job_runner
+from mailer import mailer
+from responses import static_fingerprint, compress_response, STATIC_CACHE_CONTROL
 
 app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY', 'medical-reminder-system-secret-key')
@@ -16,44 +19,152 @@ app.secret_key = os.getenv('SECRET_KEY', 'medical-reminder-system-secret-key')
 # Load environment variables
 load_dotenv()
 
-# Automation: Daily reminder check at 8:00 AM
+# Seconds in-flight sends get to finish when the process is asked to stop
+DRAIN_TIMEOUT = int(os.getenv('DRAIN_TIMEOUT', '30'))
+scheduler_stop = threading.Event()
+
+# Off-peak hour at which upcoming reminder messages are rendered and staged
+PRECOMPUTE_HOUR = int(os.getenv('PRECOMPUTE_HOUR', '2'))
+
+# Shared secret the messaging provider sends with inbound replies; unset disables the webhook
+WEBHOOK_TOKEN = os.getenv('WEBHOOK_TOKEN')
+
+# Morning hour at which each staff member is emailed the day's schedule
+SCHEDULE_EMAIL_HOUR = int(os.getenv('SCHEDULE_EMAIL_HOUR', '7'))
+
+# How often the scheduler sends reminders whose spread-out send slot has come up
+SEND_POLL_SECONDS = int(os.getenv('SEND_POLL_SECONDS', '60'))
+
+def next_run_at(hour, now):
+    target_time = now.replace(hour=hour, minute=0, second=0, microsecond=0)
+    if now > target_time:
+        target_time += datetime.timedelta(days=1)
+    return target_time
+
+# Automation: Overnight precompute and archive, morning schedule emails, and
+# reminders sent as their send slots come up inside each recipient's local send window
 def automated_reminder_check():
-    while True:
-        now = datetime.datetime.now()
-        target_time = now.replace(hour=8, minute=0, second=0, microsecond=0)
-        if now > target_time:
-            target_time += datetime.timedelta(days=1)
-        sleep_seconds = (target_time - now).total_seconds()
-        time.sleep(sleep_seconds)
-        print("🚀 Running automated daily reminder check...")
-        reminder_system.check_reminders()
-
-# Start the automation thread
-threading.Thread(target=automated_reminder_check, daemon=True).start()
+    precompute_time = next_run_at(PRECOMPUTE_HOUR, datetime.datetime.now())
+    schedule_email_time = next_run_at(SCHEDULE_EMAIL_HOUR, datetime.datetime.now())
+    while not scheduler_stop.wait(SEND_POLL_SECONDS):
+        try:
+            if datetime.datetime.now() >= precompute_time:
+                print("🗂️ Precomputing upcoming reminders...")
+                reminder_system.precompute_reminders()
+                reminder_system.archive_old_appointments()
+                precompute_time = next_run_at(PRECOMPUTE_HOUR, datetime.datetime.now())
+            if datetime.datetime.now() >= schedule_email_time:
+                send_schedule_emails()
+                schedule_email_time = next_run_at(SCHEDULE_EMAIL_HOUR, datetime.datetime.now())
+            # A manual run may still be going; its rows are picked up by the next poll otherwise
+            if not reminder_system.reminder_run_lock.locked():
+                reminder_system.check_reminders()
+        except Exception as e:
+            print(f"❌ Automated reminder check stopped: {str(e)}")
+
+def start_workers():
+    """Start the job loop and the daily automation thread, and drain them when the process exits.
+
+    Call this only in the process that serves requests. The debug
+    reloader's watcher process imports this module too, and a scheduler
+    there would send the same reminders a second time.
+    """
+    job_runner.start()
+    threading.Thread(target=automated_reminder_check, name='reminder-scheduler', daemon=True).start()
+    atexit.register(stop_workers)
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, handle_sigterm)
+
+def stop_workers():
+    """Stop scheduling new work and drain in-flight sends"""
+    if scheduler_stop.is_set():
+        return
+    print("🛑 Shutting down background workers...")
+    scheduler_stop.set()
+    job_runner.shutdown(DRAIN_TIMEOUT)
+    reminder_system.flush_writes()
+    mailer.close()
+
+def handle_sigterm(signum, frame):
+    # Turn SIGTERM into a normal exit so the atexit drain runs
+    raise SystemExit(0)
+
+@app.before_request
+def revalidate_session():
+    """Log out sessions whose staff account no longer exists"""
+    if request.endpoint == 'static' or not session.get('logged_in'):
+        return
+    if reminder_system.get_staff_by_username(session.get('username')) is None:
+        session.pop('logged_in', None)
+        session.pop('username', None)
+        flash('Your account is no longer active. Please log in again.', 'error')
+        return redirect(url_for('auth'))
+
+@app.url_defaults
+def fingerprint_static_urls(endpoint, values):
+    """Add a content hash to static URLs so they can be cached as immutable"""
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        fingerprint = static_fingerprint(app.static_folder, values['filename'])
+        if fingerprint:
+            values['v'] = fingerprint
+
+@app.after_request
+def cache_and_compress(response):
+    """Long-lived caching for fingerprinted static files, gzip for large HTML and JSON"""
+    if request.endpoint == 'static' and request.args.get('v'):
+        response.headers['Cache-Control'] = STATIC_CACHE_CONTROL
+    return compress_response(response, request.accept_encodings)
+
+def appointments_etag(include_archived):
+    """Weak ETag for the appointment lists, or None when the page can't be revalidated"""
+    # A page carrying flashed messages differs from the cached copy
+    if session.get('_flashes'):
+        return None
+    version = reminder_system.get_data_version()
+    return f"appointments-{version}-{int(include_archived)}" if version else None
+
+def conditional_response(etag, build):
+    """304 if the client's copy matches etag, otherwise the response from build()"""
+    if etag and request.if_none_match.contains_weak(etag):
+        response = make_response('', 304)
+    else:
+        response = make_response(build())
+    if etag:
+        response.set_etag(etag, weak=True)
+        # Per-user pages: browsers may keep them but must revalidate each time
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 def send_reset_email(email, token):
-    """Send password reset email"""
+    """Queue the password reset email; it is sent in the background.
+    Returns False only if it could not be queued - the mailer logs delivery failures"""
     try:
-        msg = MIMEText(f"""
+        msg = mailer.build_message(email, 'MedReminder Password Reset', f"""
         To reset your MedReminder password, click the link below:
         http://localhost:5000/reset-password/{token}
 
         This link will expire in 1 hour. If you didn't request a reset, ignore this email.
         """)
-        msg['Subject'] = 'MedReminder Password Reset'
-        msg['From'] = os.getenv('EMAIL_ADDRESS')
-        msg['To'] = email
-
-        with smtplib.SMTP(os.getenv('SMTP_SERVER'), os.getenv('SMTP_PORT')) as server:
-            server.starttls()
-            server.login(os.getenv('EMAIL_ADDRESS'), os.getenv('EMAIL_PASSWORD'))
-            server.send_message(msg)
-        print(f"✅ Password reset email sent to {email}")
+        mailer.send_later([msg])
         return True
     except Exception as e:
         print(f"❌ Error sending reset email: {str(e)}")
         return False
 
+def send_schedule_emails(date=None):
+    """Email every staff member the day's appointments, as one batch over one SMTP session"""
+    date = date or datetime.date.today().isoformat()
+    appointments = reminder_system.get_schedule(date)
+    lines = [f"{apt['appointment_time']}  Dr. {apt['doctor_name']}  -  {apt['patient_name']} ({apt['patient_phone']})"
+             for apt in appointments]
+    body = f"Appointments for {date}:\n\n" + ("\n".join(lines) if lines else "No appointments scheduled.")
+    messages = [mailer.build_message(staff['email'], f'MedReminder schedule for {date}', body)
+                for staff in reminder_system.get_all_staff() if staff['email']]
+    if messages:
+        print(f"📧 Sending the {date} schedule ({len(appointments)} appointments) to {len(messages)} staff")
+        mailer.send_later(messages)
+    return len(messages)
+
 @app.route('/auth', methods=['GET', 'POST'])
 def auth():
     if session.get('logged_in'):
@@ -97,9 +208,9 @@ def reset_password_request():
         if staff:
             token = reminder_system.generate_reset_token(email)
             if send_reset_email(email, token):
-                flash('Password reset link sent to your email!', 'success')
+                flash('Password reset email queued. It should arrive within a few minutes.', 'success')
             else:
-                flash('Failed to send reset email. Please try again.', 'error')
+                flash('Could not queue the reset email. Please try again.', 'error')
         else:
             flash('Email not found.', 'error')
     return render_template('reset_password_request.html')
@@ -115,7 +226,7 @@ def reset_password(token):
     if request.method == 'POST':
         username = request.form['username']
         new_password = request.form['password']
-        if reminder_system.validate_staff(username, None):  # Check if username exists
+        if reminder_system.get_staff_by_username(username):  # Check if username exists
             if reminder_system.reset_password(username, new_password):
                 flash('Password reset successfully! Please log in.', 'success')
                 return redirect(url_for('auth'))
@@ -163,8 +274,8 @@ def index():
     today = datetime.datetime.now().date().isoformat()
     tomorrow = (datetime.datetime.now() + datetime.timedelta(days=1)).date().isoformat()
     
-    today_appointments = [apt for apt in appointments if apt[5] == today]
-    tomorrow_appointments = [apt for apt in appointments if apt[5] == tomorrow]
+    today_appointments = [apt for apt in appointments if apt['appointment_date'] == today]
+    tomorrow_appointments = [apt for apt in appointments if apt['appointment_date'] == tomorrow]
     
     return render_template('index.html', 
                          today_appointments=today_appointments,
@@ -184,10 +295,11 @@ def add_appointment():
             doctor_phone = request.form['doctor_phone']
             appointment_date = request.form['appointment_date']
             appointment_time = request.form['appointment_time']
+            timezone = request.form.get('timezone', '').strip() or None
             
             reminder_system.add_appointment(
                 patient_name, patient_phone, doctor_name, 
-                doctor_phone, appointment_date, appointment_time
+                doctor_phone, appointment_date, appointment_time, timezone
             )
             
             flash('Appointment added successfully!', 'success')
@@ -196,15 +308,18 @@ def add_appointment():
         except Exception as e:
             flash(f'Error adding appointment: {str(e)}', 'error')
     
-    return render_template('add_appointment.html')
+    return render_template('add_appointment.html', default_timezone=DEFAULT_TIMEZONE)
 
 @app.route('/appointments')
 def view_appointments():
     if not session.get('logged_in'):
         return redirect(url_for('auth'))
     """View all appointments"""
-    appointments = reminder_system.get_all_appointments()
-    return render_template('appointments.html', appointments=appointments)
+    show_archived = request.args.get('archived') == '1'
+    return conditional_response(appointments_etag(show_archived), lambda: render_template(
+        'appointments.html',
+        appointments=reminder_system.get_all_appointments(include_archived=show_archived),
+        show_archived=show_archived))
 
 @app.route('/delete-appointment/<int:appointment_id>')
 def delete_appointment(appointment_id):
@@ -219,26 +334,52 @@ def delete_appointment(appointment_id):
     
     return redirect(url_for('view_appointments'))
 
-@app.route('/send-reminders')
+@app.route('/send-reminders', methods=['GET', 'POST'])
 def send_reminders():
     if not session.get('logged_in'):
         return redirect(url_for('auth'))
-    """Manually send reminders"""
-    try:
-        results = reminder_system.check_reminders()
-        
-        if results:
-            successful = sum(1 for r in results if r['reminder_sent'])
-            message = f"Reminders processed: {successful} successful out of {len(results)} appointments"
-            flash(message, 'success' if successful > 0 else 'warning')
-        else:
-            flash('No reminders to send at this time.', 'info')
-            
-        return render_template('send_reminders.html', results=results)
-        
-    except Exception as e:
-        flash(f'Error sending reminders: {str(e)}', 'error')
-        return render_template('send_reminders.html', results=[])
+    """Manually send reminders as a background job"""
+    if request.method == 'POST' and reminder_system.reminder_run_lock.locked():
+        flash('A reminder run is already in progress. Try again when it has finished.', 'info')
+    elif request.method == 'POST':
+        try:
+            # A manual run sends everything whose send window is open now, without waiting for its slot
+            job_id = job_runner.submit(
+                'Manual reminder check',
+                lambda on_result: reminder_system.check_reminders_async(on_result, ignore_spread=True))
+            flash('Reminder job started. Results will appear below as they complete.', 'info')
+            return redirect(url_for('send_reminders', job=job_id))
+        except Exception as e:
+            flash(f'Error sending reminders: {str(e)}', 'error')
+    
+    job = None
+    job_id = request.args.get('job')
+    if job_id:
+        job = job_runner.get(job_id)
+        if job is None:
+            flash('Reminder job not found.', 'error')
+    
+    return render_template('send_reminders.html', job=job, results=job['results'] if job else [])
+
+def get_requested_job():
+    """The job named by the `job` query parameter, flashing an error if it is unknown"""
+    job_id = request.args.get('job')
+    if not job_id:
+        return None
+    job = job_runner.get(job_id)
+    if job is None:
+        flash('Job not found.', 'error')
+    return job
+
+@app.route('/api/jobs/<job_id>')
+def api_job(job_id):
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    """API endpoint to poll a background job for results after `since`"""
+    job = job_runner.get(job_id, since=request.args.get('since', 0, type=int))
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
 
 @app.route('/test-sms', methods=['GET', 'POST'])
 def test_sms():
@@ -263,60 +404,140 @@ def api_appointments():
     if not session.get('logged_in'):
         return jsonify({'error': 'Unauthorized'}), 401
     """API endpoint to get appointments"""
-    appointments = reminder_system.get_all_appointments()
-    appointments_list = []
+    include_archived = request.args.get('archived') == '1'
     
-    for apt in appointments:
-        appointments_list.append({
-            'id': apt[0],
-            'patient_name': apt[1],
-            'patient_phone': apt[2],
-            'doctor_name': apt[3],
-            'doctor_phone': apt[4],
-            'appointment_date': apt[5],
-            'appointment_time': apt[6],
-            'reminder_sent': bool(apt[7])
-        })
+    def build():
+        appointments = reminder_system.get_all_appointments(include_archived=include_archived)
+        return jsonify([appointment_to_dict(apt) for apt in appointments])
+    
+    return conditional_response(appointments_etag(include_archived), build)
+
+@app.route('/api/appointments/search')
+def api_search_appointments():
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    """API endpoint to search appointments by patient/doctor name or phone"""
+    query = request.args.get('q', '')
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 20, type=int), 1), 100)
+    appointments, total = reminder_system.search_appointments(query, page, per_page)
     
-    return jsonify(appointments_list)
+    return jsonify({
+        'query': query,
+        'page': page,
+        'per_page': per_page,
+        'total': total,
+        'results': [appointment_to_dict(apt) for apt in appointments]
+    })
+
+@app.route('/api/metrics')
+def api_metrics():
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    """API endpoint exposing the adaptive send concurrency state"""
+    return jsonify({'send_concurrency': reminder_system.send_limiter.snapshot()})
+
+@app.route('/api/doctors/free-slots')
+def api_free_slots():
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    """API endpoint to list a doctor's bookable start times on a date"""
+    doctor_phone = request.args.get('doctor_phone', '')
+    appointment_date = request.args.get('date', '')
+    if not doctor_phone or not appointment_date:
+        return jsonify({'error': 'doctor_phone and date are required'}), 400
+    try:
+        datetime.datetime.strptime(appointment_date, '%Y-%m-%d')
+    except ValueError:
+        return jsonify({'error': 'date must be in YYYY-MM-DD format'}), 400
+
+    return jsonify({
+        'doctor_phone': doctor_phone,
+        'date': appointment_date,
+        'free_slots': reminder_system.find_free_slots(doctor_phone, appointment_date)
+    })
+
+def appointment_to_dict(apt):
+    """Serialize an appointment row for the JSON API"""
+    return {
+        'id': apt['id'],
+        'patient_name': apt['patient_name'],
+        'patient_phone': apt['patient_phone'],
+        'doctor_name': apt['doctor_name'],
+        'doctor_phone': apt['doctor_phone'],
+        'appointment_date': apt['appointment_date'],
+        'appointment_time': apt['appointment_time'],
+        'reminder_sent': bool(apt['reminder_sent']),
+        'status': apt['status']
+    }
+
+@app.route('/webhooks/whatsapp', methods=['POST'])
+def whatsapp_webhook():
+    """Inbound WhatsApp replies: CONFIRM or CANCEL followed by the token from the reminder"""
+    if not WEBHOOK_TOKEN:
+        return jsonify({'error': 'Webhook disabled'}), 404
+    supplied = request.headers.get('X-Webhook-Token') or request.args.get('token', '')
+    if not hmac.compare_digest(supplied.encode(), WEBHOOK_TOKEN.encode()):
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    payload = request.get_json(silent=True) or request.form
+    phone = payload.get('from') or payload.get('phone')
+    text = payload.get('text') or payload.get('message') or payload.get('body')
+    if not phone or not text:
+        return jsonify({'error': 'from and text are required'}), 400
+    
+    # Unmatched replies are still acknowledged so the provider doesn't retry them
+    reply = reminder_system.handle_reply(phone, text)
+    if reply is None:
+        return jsonify({'matched': False})
+    appointment_id, status = reply
+    return jsonify({'matched': True, 'appointment_id': appointment_id, 'status': status})
 
 @app.route('/test-whatsapp', methods=['GET', 'POST'])
 def test_whatsapp():
     if not session.get('logged_in'):
         return redirect(url_for('auth'))
-    """Test WhatsApp functionality"""
+    """Test WhatsApp functionality as a background job"""
     if request.method == 'POST':
         phone_number = request.form['phone_number']
         test_message = request.form['test_message']
         
-        success, message = reminder_system.test_whatsapp(phone_number, test_message)
-        
-        if success:
-            flash(f'WhatsApp test sent successfully: {message}', 'success')
-        else:
-            flash(f'Failed to send WhatsApp: {message}', 'error')
+        try:
+            job_id = job_runner.submit(
+                'WhatsApp test',
+                lambda on_result: reminder_system.test_whatsapp(phone_number, test_message))
+            flash('WhatsApp test started. Its status appears below.', 'info')
+            return redirect(url_for('test_whatsapp', job=job_id))
+        except Exception as e:
+            flash(f'Failed to send WhatsApp: {str(e)}', 'error')
     
-    return render_template('test_whatsapp.html')
+    return render_template('test_whatsapp.html', job=get_requested_job())
 
 @app.route('/send-test-reminder', methods=['GET', 'POST'])
 def send_test_reminder():
     if not session.get('logged_in'):
         return redirect(url_for('auth'))
-    """Send a test reminder immediately (bypass date check)"""
+    """Send a test reminder immediately (bypass date check) as a background job"""
     if request.method == 'POST':
         phone_number = request.form['phone_number']
         test_message = request.form['test_message']
         
-        success, message = reminder_system.send_test_reminder(phone_number, test_message)
-        
-        if success:
-            flash(f'Test reminder sent successfully: {message}', 'success')
-        else:
-            flash(f'Failed to send test reminder: {message}', 'error')
+        try:
+            job_id = job_runner.submit(
+                'Test reminder',
+                lambda on_result: reminder_system.send_test_reminder(phone_number, test_message))
+            flash('Test reminder started. Its status appears below.', 'info')
+            return redirect(url_for('send_test_reminder', job=job_id))
+        except Exception as e:
+            flash(f'Failed to send test reminder: {str(e)}', 'error')
     
-    return render_template('test_reminder.html')
+    return render_template('test_reminder.html', job=get_requested_job())
 
 if __name__ == '__main__':
+    # The debug reloader runs this file in a watcher process and again in the
+    # serving child it restarts on changes; only the child runs the workers
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_workers()
     print("Starting Medical Reminder System...")
     print("Access your application at: http://localhost:5000")
     print("Press Ctrl+C to stop the server")
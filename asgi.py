@@ -0,0 +1,9 @@
+# asgi.py - ASGI entry point, e.g. `uvicorn asgi:asgi_app --port 5000`
+from asgiref.wsgi import WsgiToAsgi
+from app import app, start_workers
+
+# The ASGI server imports this module only in the process that serves requests,
+# so the job loop and the reminder scheduler start here rather than in app.py
+start_workers()
+
+asgi_app = WsgiToAsgi(app)
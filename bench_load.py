@@ -0,0 +1,267 @@
+# bench_load.py - Throughput and tail latency of the Flask routes against large databases
+# Usage: python bench_load.py [appointments ...] [--sessions 8] [--requests 25]
+#                             [--baseline load_baseline.json] [--save-baseline load_baseline.json]
+#        python bench_load.py 100000 --db /tmp/load.db --seed-only    # seed a database for a server
+#        python bench_load.py 100000 --url http://127.0.0.1:5000      # drive that running server
+import argparse
+import contextlib
+import datetime
+import itertools
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+
+STAFF_USERNAME = 'loadtest'
+STAFF_PASSWORD = 'loadtest-password'
+DOCTORS = 200
+# Booking numbers stay unique across sessions, sizes and runs, so bookings never conflict
+BOOKINGS = itertools.count(int(time.time()) * 1000)
+
+# Route mix for each simulated staff session: (name, weight, method, path, expected status codes).
+# Logins and bookings are write paths and bcrypt-bound, so they are weighted lower than reads.
+ROUTES = [
+    ('login', 1, 'POST', '/auth', (302,)),
+    ('dashboard', 4, 'GET', '/', (200,)),
+    ('appointments', 2, 'GET', '/appointments', (200,)),
+    ('api_appointments', 2, 'GET', '/api/appointments', (200,)),
+    ('api_search', 4, 'GET', '/api/appointments/search?q=Patient+42', (200,)),
+    ('book', 1, 'POST', '/add-appointment', (302,))
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Load-test the Flask routes against seeded appointment databases')
+    parser.add_argument('sizes', nargs='*', type=int, default=[10_000],
+                        help='appointment counts to seed and test, e.g. 10000 100000 1000000')
+    parser.add_argument('--sessions', type=int, default=8, help='concurrent staff sessions')
+    parser.add_argument('--requests', type=int, default=25, help='requests per session per size')
+    parser.add_argument('--routes', help='comma-separated subset of routes to exercise')
+    parser.add_argument('--seed', type=int, default=42, help='random seed for the route mix')
+    parser.add_argument('--db', help='database file to create (default: a temporary file)')
+    parser.add_argument('--seed-only', action='store_true', help='seed --db and exit, for serving with DATABASE_PATH')
+    parser.add_argument('--url', help='drive a running server instead of the Flask test client')
+    parser.add_argument('--baseline', help='JSON baseline to compare against; regressions exit with status 1')
+    parser.add_argument('--save-baseline', help='write this run as a JSON baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed p95 increase or throughput drop versus the baseline (default 0.25)')
+    args = parser.parse_args()
+    if args.db and os.path.exists(args.db):
+        parser.error(f'{args.db} already exists; seeding needs a fresh database file')
+    if args.seed_only and not args.db:
+        parser.error('--seed-only needs --db')
+    return args
+
+
+def seed(db_path, count):
+    """Top the database up to `count` deterministic appointments spread around today"""
+    today = datetime.date.today()
+    conn = sqlite3.connect(db_path)
+    existing = conn.execute("SELECT COUNT(*) FROM appointments WHERE patient_name LIKE 'Patient %'").fetchone()[0]
+    started = time.perf_counter()
+    for start in range(existing, count, 50_000):
+        rows = []
+        for i in range(start, min(count, start + 50_000)):
+            doctor = i % DOCTORS
+            # 60 days of history to 30 days ahead, on the clinic's half-hour grid
+            date = today + datetime.timedelta(days=(i * 7919) % 91 - 60)
+            slot = (i * 31) % 18
+            rows.append((f'Patient {i}', f'+2547{i:08d}', f'Doctor {doctor}', f'+2541{doctor:08d}',
+                         date.isoformat(), f'{8 + slot // 2:02d}:{slot % 2 * 30:02d}'))
+        conn.executemany('''INSERT INTO appointments
+                            (patient_name, patient_phone, doctor_name, doctor_phone, appointment_date, appointment_time)
+                            VALUES (?, ?, ?, ?, ?, ?)''', rows)
+        conn.commit()
+    conn.close()
+    if count > existing:
+        print(f"🌱 Seeded {count - existing:,} appointments ({count:,} total) in {time.perf_counter() - started:.1f}s")
+
+
+class Session:
+    """One simulated staff member, logged in over the test client or HTTP"""
+
+    def __init__(self, number, url=None, app=None):
+        self.number = number
+        self.url = url
+        self.app = app
+        self.client = self.new_client()
+        self.request('POST', '/auth', self.login_form())
+
+    def new_client(self):
+        if self.url:
+            return httpx.Client(base_url=self.url, timeout=300)
+        return self.app.test_client()
+
+    def login_form(self):
+        return {'action': 'login', 'username': STAFF_USERNAME, 'password': STAFF_PASSWORD}
+
+    def booking_form(self):
+        # A doctor of its own per booking, far ahead, so bookings never hit a conflict
+        booking = next(BOOKINGS)
+        return {
+            'patient_name': f'Load Patient {booking}',
+            'patient_phone': f'+2546{booking}',
+            'doctor_name': f'Load Doctor {booking}',
+            'doctor_phone': f'+2548{booking}',
+            'appointment_date': (datetime.date.today() + datetime.timedelta(days=365)).isoformat(),
+            'appointment_time': '09:00'
+        }
+
+    def request(self, method, path, data=None, client=None):
+        client = client or self.client
+        if method == 'POST':
+            return client.post(path, data=data).status_code
+        return client.get(path).status_code
+
+    def hit(self, name, method, path):
+        if name == 'login':
+            # Logging in from an already logged-in session just redirects, so use a fresh one
+            client = self.new_client()
+            return self.request(method, path, self.login_form(), client)
+        if name == 'book':
+            return self.request(method, path, self.booking_form())
+        return self.request(method, path)
+
+
+def run_load(args, routes, app=None):
+    """Run every session's requests concurrently; return {route: [latencies]}, error counts and duration"""
+    latencies = {name: [] for name, *_ in routes}
+    errors = {name: 0 for name, *_ in routes}
+    lock = threading.Lock()
+    picker = random.Random(args.seed)
+    plans = [picker.choices(routes, weights=[route[1] for route in routes], k=args.requests)
+             for _ in range(args.sessions)]
+
+    def work(session, plan):
+        for name, _, method, path, expected in plan:
+            started = time.perf_counter()
+            try:
+                status = session.hit(name, method, path)
+            except Exception:
+                status = None
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                latencies[name].append(elapsed)
+                if status not in expected:
+                    errors[name] += 1
+
+    # The app logs every login, send and query; keep it out of the report
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        sessions = [Session(number, args.url, app) for number in range(args.sessions)]
+        threads = [threading.Thread(target=work, args=(session, plan)) for session, plan in zip(sessions, plans)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.perf_counter() - started
+    return latencies, errors, duration
+
+
+def percentile(values, share):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+
+def summarize(latencies, errors, duration):
+    summary = {}
+    for name, values in latencies.items():
+        if not values:
+            continue
+        summary[name] = {
+            'requests': len(values),
+            'errors': errors[name],
+            'rps': round(len(values) / duration, 2),
+            'p50_ms': round(percentile(values, 0.50), 1),
+            'p95_ms': round(percentile(values, 0.95), 1),
+            'p99_ms': round(percentile(values, 0.99), 1),
+            'max_ms': round(max(values), 1)
+        }
+    return summary
+
+
+def report(size, summary, baseline, tolerance):
+    """Print one size's table and return the regressions found against the baseline"""
+    print(f"\n📊 {size:,} appointments")
+    print(f"{'route':<18}{'reqs':>6}{'errors':>8}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    regressions = []
+    for name, stats in summary.items():
+        flag = ''
+        previous = baseline.get(name)
+        if previous:
+            if stats['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+                flag = f"  ⚠️ p95 was {previous['p95_ms']} ms"
+            elif stats['rps'] < previous['rps'] * (1 - tolerance):
+                flag = f"  ⚠️ req/s was {previous['rps']}"
+            if stats['errors'] > previous['errors']:
+                flag += f"  ⚠️ errors were {previous['errors']}"
+            if flag:
+                regressions.append(f"{size:,} {name}:{flag.replace('  ⚠️', '')}")
+        print(f"{name:<18}{stats['requests']:>6}{stats['errors']:>8}{stats['rps']:>9}"
+              f"{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}{stats['max_ms']:>10}{flag}")
+    return regressions
+
+
+def main():
+    args = parse_args()
+    routes = ROUTES
+    if args.routes:
+        wanted = args.routes.split(',')
+        routes = [route for route in ROUTES if route[0] in wanted]
+
+    app = None
+    if not args.url:
+        # Work on a throwaway database so the real appointments.db is never touched.
+        # Importing app does not start the reminder scheduler, so no reminder sends
+        # run during the measurements
+        os.environ['DATABASE_PATH'] = args.db or os.path.join(tempfile.mkdtemp(), 'load.db')
+        from reminder import reminder_system, DB_PATH
+        from app import app
+
+        # Booking confirmations go to a stub provider instead of CallMeBot
+        reminder_system.http_client = httpx.AsyncClient(transport=httpx.MockTransport(
+            lambda request: httpx.Response(200, text='Message queued. You will receive it in a few seconds.')))
+        reminder_system.add_staff(STAFF_USERNAME, STAFF_PASSWORD, 'loadtest@example.com')
+
+    baselines = {}
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+
+    results = {}
+    regressions = []
+    for size in sorted(args.sizes):
+        if not args.url:
+            seed(DB_PATH, size)
+        if args.seed_only:
+            continue
+        latencies, errors, duration = run_load(args, routes, app)
+        results[str(size)] = summarize(latencies, errors, duration)
+        regressions += report(size, results[str(size)], baselines.get(str(size), {}), args.tolerance)
+
+    if args.seed_only:
+        print(f"✅ Seeded {args.db}; serve it with DATABASE_PATH={args.db} and log in as "
+              f"{STAFF_USERNAME} / {STAFF_PASSWORD}")
+        return 0
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\n💾 Baseline saved to {args.save_baseline}")
+    if regressions:
+        print(f"\n❌ {len(regressions)} regressions (tolerance {args.tolerance:.0%}):")
+        for regression in regressions:
+            print(f"   {regression}")
+        return 1
+    if baselines:
+        print("\n✅ No regressions against the baseline")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,146 @@
+# bench_memory.py - Peak memory of a reminder run, before and after streaming, per 100k appointments
+# Usage: python bench_memory.py [appointments]
+import contextlib
+import datetime
+import os
+import sqlite3
+import sys
+import tempfile
+import tracemalloc
+import urllib.parse
+
+import httpx
+
+COUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+
+# Work on a throwaway database so the real appointments.db is never touched, and
+# keep every send window open so the whole batch is due whenever this runs
+os.environ['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ['DEFAULT_TIMEZONE'] = 'UTC'
+os.environ['SEND_WINDOW_START'] = '00:00'
+os.environ['SEND_WINDOW_END'] = '23:59'
+
+from reminder import reminder_system, DB_PATH, CALLMEBOT_API_URL
+from jobs import job_runner
+
+TOMORROW = (datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=1)).date().isoformat()
+
+
+def stub_provider(request):
+    return httpx.Response(200, text='Message queued. You will receive it in a few seconds.')
+
+
+def seed(start, stop):
+    """Book appointments start..stop-1 for tomorrow (UTC) and stage their reminders"""
+    conn = sqlite3.connect(DB_PATH)
+    conn.executemany('''INSERT INTO appointments
+                        (patient_name, patient_phone, doctor_name, doctor_phone, appointment_date, appointment_time)
+                        VALUES (?, ?, ?, ?, ?, ?)''',
+                     ((f'Patient {i}', f'+2547{i:08d}', f'Doctor {i % 50}', f'+2541{i:08d}',
+                       TOMORROW, f'{8 + i % 9:02d}:{i % 4 * 15:02d}') for i in range(start, stop)))
+    conn.commit()
+    conn.close()
+    reminder_system.precompute_reminders(appointment_date=TOMORROW)
+
+
+def reset():
+    """Make every appointment due again for the next pass"""
+    conn = sqlite3.connect(DB_PATH)
+    conn.execute('UPDATE appointments SET reminder_sent = 0, whatsapp_sent = 0')
+    conn.execute('UPDATE reminder_batches SET attempts = 0, next_attempt_at = NULL, last_status = NULL')
+    conn.execute('DELETE FROM deliveries')
+    conn.commit()
+    conn.close()
+
+
+def before_run():
+    """check_reminders before streaming: SELECT * tuples, a 10-key dict each, one send at a
+    time and a list of result dicts, committed at the end (without the 3 s pause per send)"""
+    client = httpx.Client(transport=httpx.MockTransport(stub_provider))
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    c.execute('SELECT * FROM appointments WHERE appointment_date = ? AND reminder_sent = 0', (TOMORROW,))
+    appointments = c.fetchall()
+    results = []
+    for appointment in appointments:
+        appt_data = {
+            'id': appointment[0] if len(appointment) > 0 else None,
+            'patient_name': appointment[1] if len(appointment) > 1 else 'Unknown',
+            'patient_phone': appointment[2] if len(appointment) > 2 else '',
+            'doctor_name': appointment[3] if len(appointment) > 3 else 'Unknown',
+            'doctor_phone': appointment[4] if len(appointment) > 4 else '',
+            'appointment_date': appointment[5] if len(appointment) > 5 else '',
+            'appointment_time': appointment[6] if len(appointment) > 6 else '',
+            'reminder_sent': appointment[7] if len(appointment) > 7 else 0,
+            'whatsapp_sent': appointment[8] if len(appointment) > 8 else 0,
+            'confirmation_sent': appointment[9] if len(appointment) > 9 else 0
+        }
+        messages = reminder_system.render_reminder_messages(appt_data)
+        outcomes = []
+        for phone, message in messages.values():
+            url = (f"{CALLMEBOT_API_URL}?phone={reminder_system.normalize_phone(phone)}"
+                   f"&text={urllib.parse.quote(message)}&apikey={reminder_system.whatsapp_api_key}")
+            text = client.get(url).text
+            success = any(word in text.lower() for word in ['message queued', 'message sent', 'success'])
+            outcomes.append((success, "WhatsApp message sent successfully! ✅" if success else f"WhatsApp API: {text}"))
+        (patient_success, patient_msg), (doctor_success, doctor_msg) = outcomes
+        if patient_success and doctor_success:
+            c.execute('UPDATE appointments SET reminder_sent = 1, whatsapp_sent = 1 WHERE id = ?', (appt_data['id'],))
+        results.append({
+            'appointment_id': appt_data['id'],
+            'patient_name': appt_data['patient_name'],
+            'doctor_name': appt_data['doctor_name'],
+            'patient_phone': appt_data['patient_phone'],
+            'doctor_phone': appt_data['doctor_phone'],
+            'whatsapp_patient_success': patient_success,
+            'whatsapp_patient_message': patient_msg,
+            'whatsapp_doctor_success': doctor_success,
+            'whatsapp_doctor_message': doctor_msg,
+            'reminder_sent': patient_success and doctor_success
+        })
+    conn.commit()
+    conn.close()
+    client.close()
+    return len(results)
+
+
+def after_run():
+    """check_reminders_async now: paged rows, concurrent sends, each result dropped once reported"""
+    return job_runner.run(reminder_system.check_reminders_async(ignore_spread=True)).result()['processed']
+
+
+def measure(run):
+    """Peak bytes allocated during one run"""
+    reset()
+    tracemalloc.start()
+    processed = run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return processed, peak
+
+
+if __name__ == '__main__':
+    # The pipeline sends to a stub provider instead of CallMeBot
+    reminder_system.http_client = httpx.AsyncClient(transport=httpx.MockTransport(stub_provider))
+    runs = [('before: dicts, accumulated', before_run), ('after: rows + records, streamed', after_run)]
+
+    # Each approach runs at half and full size; the difference is what each extra
+    # appointment costs, separate from the fixed cost of a run
+    half = COUNT // 2
+    peaks = {name: [] for name, _ in runs}
+    # The pipeline logs every appointment and send; keep it out of the report
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for start, stop in ((0, half), (half, COUNT)):
+            seed(start, stop)
+            for name, run in runs:
+                processed, peak = measure(run)
+                assert processed == stop, f"{name} processed {processed} of {stop} appointments"
+                peaks[name].append(peak)
+
+    print(f"\n📊 Peak memory of a reminder run for {COUNT:,} appointments")
+    print(f"{'':<34}{'peak MB':>10}{'MB per 100k':>14}")
+    baseline = None
+    for name, (half_peak, full_peak) in peaks.items():
+        per_100k = max(0, full_peak - half_peak) * 100_000 / (COUNT - half) / 1024 / 1024
+        baseline = baseline or per_100k
+        print(f"{name:<34}{full_peak / 1024 / 1024:>10.1f}{per_100k:>14.1f}  ({per_100k / baseline:.0%} of before)")
@@ -0,0 +1,40 @@
+# cache.py - Small in-process read-through cache
+import threading
+import time
+
+
+class TTLCache:
+    """Thread-safe read-through cache whose entries expire after `ttl` seconds"""
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.entries = {}
+        # Bumped on every invalidation, so a load that started before one is not stored
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, loader):
+        """Return the cached value for key, calling loader() on a miss or expiry"""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > now:
+                return entry[1]
+            generation = self.generation
+        value = loader()
+        with self.lock:
+            if self.generation == generation:
+                self.entries[key] = (now + self.ttl, value)
+        return value
+
+    def invalidate(self, key):
+        """Drop a single entry"""
+        with self.lock:
+            self.entries.pop(key, None)
+            self.generation += 1
+
+    def clear(self):
+        """Drop every entry"""
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
@@ -0,0 +1,65 @@
+# debug_replies.py - Local stand-in for the provider's inbound reply webhook
+# Usage: python debug_replies.py                                   # list recent reply tokens
+#        python debug_replies.py CONFIRM <token> <phone> [app url]  # post a reply as that phone
+import json
+import os
+import sqlite3
+import sys
+import urllib.error
+import urllib.request
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DB_PATH = os.getenv('DATABASE_PATH', 'appointments.db')
+APP_URL = 'http://localhost:5000'
+
+
+def list_tokens(limit=10):
+    print("📋 RECENT REMINDERS THAT CAN BE REPLIED TO")
+    print("=" * 60)
+    conn = sqlite3.connect(DB_PATH)
+    rows = conn.execute('''SELECT deliveries.token, deliveries.phone, deliveries.kind, appointments.id, appointments.status
+                           FROM deliveries JOIN appointments ON appointments.id = deliveries.appointment_id
+                           WHERE deliveries.token IS NOT NULL
+                           ORDER BY deliveries.id DESC LIMIT ?''', (limit,)).fetchall()
+    conn.close()
+    if not rows:
+        print("No delivered reminders with reply tokens yet")
+    for token, phone, kind, appointment_id, status in rows:
+        print(f"{token}  {phone:<16} {kind:<18} appointment {appointment_id} ({status})")
+
+
+def send_reply(action, token, phone, app_url=APP_URL):
+    webhook_token = os.getenv('WEBHOOK_TOKEN')
+    if not webhook_token:
+        print("❌ ERROR: WEBHOOK_TOKEN not set in .env file")
+        return False
+
+    payload = json.dumps({'from': phone, 'text': f"{action} {token}"}).encode('utf-8')
+    request = urllib.request.Request(f"{app_url}/webhooks/whatsapp", data=payload, method='POST',
+                                     headers={'Content-Type': 'application/json',
+                                              'X-Webhook-Token': webhook_token})
+    print(f"📡 Posting '{action} {token}' from {phone} to {app_url}/webhooks/whatsapp")
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            result = json.loads(response.read().decode('utf-8'))
+    except urllib.error.HTTPError as e:
+        print(f"❌ HTTP {e.code}: {e.read().decode('utf-8')}")
+        return False
+    except Exception as e:
+        print(f"❌ ERROR: {e}")
+        return False
+
+    if result.get('matched'):
+        print(f"✅ Appointment {result['appointment_id']} is now {result['status']}")
+    else:
+        print("⚠️ Reply was not matched to a delivered reminder")
+    return result.get('matched', False)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 4:
+        send_reply(sys.argv[1].upper(), sys.argv[2], sys.argv[3], *sys.argv[4:5])
+    else:
+        list_tokens()
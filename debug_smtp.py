@@ -0,0 +1,80 @@
+# debug_smtp.py - Local SMTP stand-in for staff email (needs `pip install aiosmtpd`)
+# Usage: python debug_smtp.py [port]           # print every email the app sends to 127.0.0.1:port
+#        python debug_smtp.py check [count]    # send batches through mailer.py and check they share one session
+import os
+import socket
+import sys
+import time
+from aiosmtpd.controller import Controller
+
+HOST = '127.0.0.1'
+PORT = 8025
+
+
+class StandIn:
+    """Accepts every message, printing it and the SMTP session it arrived on"""
+
+    def __init__(self, quiet=False):
+        self.sessions = set()
+        self.messages = []
+        self.quiet = quiet
+
+    async def handle_DATA(self, server, session, envelope):
+        self.sessions.add(id(session))
+        self.messages.append(envelope)
+        if not self.quiet:
+            subject = next((line[9:] for line in envelope.content.decode('utf-8', 'replace').splitlines()
+                            if line.startswith('Subject: ')), '')
+            print(f"📧 Session {len(self.sessions)}: {envelope.mail_from} -> {', '.join(envelope.rcpt_tos)}: {subject}")
+        return '250 Message accepted for delivery'
+
+
+def serve(port=PORT):
+    controller = Controller(StandIn(), hostname=HOST, port=port)
+    controller.start()
+    print(f"📭 SMTP stand-in listening on {HOST}:{port}; run the app with")
+    print(f"   SMTP_SERVER={HOST} SMTP_PORT={port} SMTP_STARTTLS=0 EMAIL_PASSWORD= python app.py")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        controller.stop()
+
+
+def check(count=5):
+    """Send two batches through mailer.py, directly and through the job runner, over one session"""
+    print("🧪 CHECKING SMTP SESSION REUSE")
+    print("=" * 60)
+    with socket.socket() as probe:
+        probe.bind((HOST, 0))
+        port = probe.getsockname()[1]
+    stand_in = StandIn(quiet=True)
+    controller = Controller(stand_in, hostname=HOST, port=port)
+    controller.start()
+    # mailer.py reads its settings at import, so point it at the stand-in first
+    os.environ.update(SMTP_SERVER=HOST, SMTP_PORT=str(port),
+                      SMTP_STARTTLS='0', EMAIL_PASSWORD='', EMAIL_ADDRESS='medreminder@example.com')
+    from mailer import mailer
+    try:
+        messages = [mailer.build_message(f'staff{i}@example.com', f'Session check {i}', 'Sent by debug_smtp.py')
+                    for i in range(count)]
+        errors = mailer.send_batch(messages)
+        errors.update(mailer.send_later(messages).result(timeout=30))
+        mailer.close()
+    finally:
+        controller.stop()
+
+    failed = {to: error for to, error in errors.items() if error}
+    print("=" * 60)
+    print(f"📨 {len(stand_in.messages)} of {count * 2} messages received over {len(stand_in.sessions)} SMTP sessions")
+    if failed or len(stand_in.messages) != count * 2 or len(stand_in.sessions) != 1:
+        print(f"❌ Expected every message over one session; errors: {failed or 'none'}")
+        return False
+    print("✅ Both batches reused one authenticated session")
+    return True
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['check']:
+        sys.exit(0 if check(*map(int, sys.argv[2:3])) else 1)
+    serve(*map(int, sys.argv[1:2]))
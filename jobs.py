@@ -0,0 +1,159 @@
+# jobs.py - Background job runner for the WhatsApp delivery pipeline
+import asyncio
+import concurrent.futures
+import datetime
+import threading
+import uuid
+
+
+class JobRunner:
+    """Runs delivery coroutines on one shared asyncio event loop.
+
+    Provider calls are awaited on this loop instead of blocking a request
+    thread each, so a single process can keep many sends in flight. Long
+    batch runs are submitted as jobs whose progress can be polled by id.
+    When a store is attached, job state and results are persisted through it
+    so they survive page reloads and restarts.
+    """
+
+    def __init__(self, store=None):
+        self.loop = None
+        self.thread = None
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.store = store
+        self.futures = set()
+        self.accepting = True
+        # Set when shutdown begins; long batches stop taking new work but finish what is in flight
+        self.stopping = threading.Event()
+
+    def start(self):
+        """Start the event loop thread if it is not already running"""
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self._run_loop, name='job-runner', daemon=True)
+            self.thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def run(self, coro):
+        """Schedule a coroutine on the job loop and return a concurrent future"""
+        if not self.accepting:
+            coro.close()
+            raise RuntimeError('Job runner is shutting down')
+        self.start()
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        with self.lock:
+            self.futures.add(future)
+        future.add_done_callback(self._forget)
+        return future
+
+    def _forget(self, future):
+        with self.lock:
+            self.futures.discard(future)
+
+    def shutdown(self, timeout=30):
+        """Stop accepting work and drain in-flight coroutines.
+
+        Batches watching `stopping` take no new work from here on. Running
+        coroutines get up to `timeout` seconds to finish; whatever is left is
+        cancelled, which runs their cleanup (e.g. flushing status writes)
+        before the loop stops.
+        """
+        self.stopping.set()
+        self.accepting = False
+        if self.thread is None:
+            return
+        with self.lock:
+            pending = list(self.futures)
+        if pending:
+            print(f"⏳ Draining {len(pending)} in-flight tasks (up to {timeout}s)...")
+            concurrent.futures.wait(pending, timeout=timeout)
+        
+        async def cancel_remaining():
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            return len(tasks)
+        
+        try:
+            cancelled = asyncio.run_coroutine_threadsafe(cancel_remaining(), self.loop).result(timeout=10)
+            if cancelled:
+                print(f"🛑 Cancelled {cancelled} tasks still running after the drain timeout")
+        except concurrent.futures.TimeoutError:
+            print("⚠️ Timed out waiting for cancelled tasks to clean up")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=5)
+        print("✅ Job runner stopped")
+
+    def submit(self, name, job_fn):
+        """Start a background job and return its id.
+
+        job_fn is called with an on_result callback and must return a
+        coroutine; every result passed to on_result is recorded on the job
+        as soon as it is reported. on_result runs on the job loop, so a store
+        must not block in save_job_result; finish_job runs in a worker thread.
+        """
+        job_id = uuid.uuid4().hex[:12]
+        job = {
+            'id': job_id,
+            'name': name,
+            'status': 'running',
+            'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+            'finished_at': None,
+            'error': None,
+            'processed': 0,
+            'results': []
+        }
+        with self.lock:
+            self.jobs[job_id] = job
+        if self.store:
+            self.store.create_job(job_id, name, job['created_at'])
+
+        def on_result(result):
+            # With a store, results go straight to it instead of piling up in memory
+            job['processed'] += 1
+            if self.store:
+                self.store.save_job_result(job_id, job['processed'], result)
+            else:
+                job['results'].append(result)
+
+        async def run_job():
+            try:
+                await job_fn(on_result)
+                job['status'] = 'completed'
+            except asyncio.CancelledError:
+                job['status'] = 'interrupted'
+                raise
+            except Exception as e:
+                job['status'] = 'failed'
+                job['error'] = str(e)
+                print(f"❌ Job {job_id} ({name}) failed: {str(e)}")
+            finally:
+                job['finished_at'] = datetime.datetime.now().isoformat(timespec='seconds')
+                if self.store:
+                    await asyncio.to_thread(self.store.finish_job, job_id, job['status'], job['finished_at'],
+                                            job['error'])
+
+        self.run(run_job())
+        print(f"🧵 Started job {job_id}: {name}")
+        return job_id
+
+    def get(self, job_id, since=0):
+        """Return a snapshot of a job with results after the first `since`, or None if unknown"""
+        if self.store:
+            return self.store.get_job(job_id, since)
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            return dict(job, results=job['results'][since:])
+
+
+# Create a global instance
+job_runner = JobRunner()
@@ -0,0 +1,109 @@
+# limiter.py - Adaptive concurrency limit for provider calls
+import asyncio
+import collections
+import time
+
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit driven by observed provider latency and errors.
+
+    While the recent p95 latency stays under target_p95_ms and the error rate
+    under max_error_rate, the limit grows by about one slot per round trip.
+    A rate-limit or transient failure halves it, and a slow p95 shrinks it by
+    a quarter, at most once per round trip so one bad burst isn't counted
+    several times. Failures that keep coming at the minimum limit also pause
+    new calls with an exponential backoff of up to max_backoff seconds, and
+    callers can pause them outright with pause().
+    """
+
+    def __init__(self, initial=2, minimum=1, maximum=10, target_p95_ms=4000,
+                 max_error_rate=0.1, window=50, max_backoff=30):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_p95_ms = target_p95_ms
+        self.max_error_rate = max_error_rate
+        self.max_backoff = max_backoff
+        self.samples = collections.deque(maxlen=window)
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.consecutive_failures = 0
+        self.resume_at = 0.0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        """Wait for a free slot under the current limit"""
+        delay = self.resume_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, latency_ms=None, failed=False):
+        """Free a slot, feeding the call's latency and outcome into the limit"""
+        async with self.condition:
+            saturated = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            if latency_ms is not None:
+                self.samples.append((latency_ms, failed))
+                self._adjust(failed, saturated)
+            self.condition.notify_all()
+
+    def _adjust(self, failed, saturated):
+        now = time.monotonic()
+        cooling_down = now - self.last_decrease < self.p95() / 1000
+        if failed:
+            self.consecutive_failures += 1
+            if self.limit <= self.minimum:
+                backoff = min(self.max_backoff, 0.5 * 2 ** (self.consecutive_failures - 1))
+                self.resume_at = max(self.resume_at, now + backoff)
+            if not cooling_down:
+                self.limit = max(self.minimum, self.limit / 2)
+                self.last_decrease = now
+            return
+        self.consecutive_failures = 0
+        if self.p95() > self.target_p95_ms:
+            if not cooling_down:
+                self.limit = max(self.minimum, self.limit * 0.75)
+                self.last_decrease = now
+        elif saturated and self.error_rate() <= self.max_error_rate:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def pause(self, seconds):
+        """Hold back new calls for `seconds`; returns False if they were already held back"""
+        now = time.monotonic()
+        running = self.resume_at <= now
+        self.resume_at = max(self.resume_at, now + seconds)
+        return running
+
+    def p95(self):
+        """95th percentile latency over the recent window, in milliseconds"""
+        if not self.samples:
+            return 0
+        latencies = sorted(latency for latency, _ in self.samples)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+    def error_rate(self):
+        """Share of failed calls over the recent window"""
+        if not self.samples:
+            return 0.0
+        return sum(1 for _, failed in self.samples if failed) / len(self.samples)
+
+    def timeout(self, floor=5, ceiling=30):
+        """Request timeout in seconds: a few times the recent p95, within bounds"""
+        if not self.samples:
+            return ceiling
+        return min(ceiling, max(floor, self.p95() * 3 / 1000))
+
+    def snapshot(self):
+        """Current state, for the metrics endpoint"""
+        return {
+            'limit': int(self.limit),
+            'in_flight': self.in_flight,
+            'p95_ms': self.p95(),
+            'error_rate': round(self.error_rate(), 3),
+            'samples': len(self.samples),
+            'paused_s': round(max(0.0, self.resume_at - time.monotonic()), 1),
+            'timeout_s': round(self.timeout(), 1)
+        }
@@ -0,0 +1,106 @@
+# mailer.py - Staff email delivery over one reused SMTP session
+import asyncio
+import os
+import smtplib
+import threading
+import time
+from email.mime.text import MIMEText
+from dotenv import load_dotenv
+from jobs import job_runner
+
+# Load environment variables
+load_dotenv()
+
+SMTP_SERVER = os.getenv('SMTP_SERVER', 'localhost')
+SMTP_PORT = int(os.getenv('SMTP_PORT', '587'))
+# Local stand-ins such as aiosmtpd speak plain SMTP; set SMTP_STARTTLS=0 for them
+SMTP_STARTTLS = os.getenv('SMTP_STARTTLS', '1') == '1'
+# Reconnect rather than reuse a session the server has probably dropped
+SMTP_IDLE_TIMEOUT = float(os.getenv('SMTP_IDLE_TIMEOUT', '60'))
+
+
+class Mailer:
+    """Sends staff emails over one authenticated SMTP session, reused across messages.
+
+    The connect, STARTTLS and login handshake happens once and the session is
+    kept open for following sends until it has been idle for
+    SMTP_IDLE_TIMEOUT. Batches are sent from the job runner's loop so
+    callers such as request handlers never wait on the SMTP server.
+    """
+
+    def __init__(self):
+        self.server = None
+        self.last_used = 0.0
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=30)
+        if SMTP_STARTTLS:
+            server.starttls()
+        if os.getenv('EMAIL_PASSWORD'):
+            server.login(os.getenv('EMAIL_ADDRESS'), os.getenv('EMAIL_PASSWORD'))
+        print(f"📧 Connected to SMTP server {SMTP_SERVER}:{SMTP_PORT}")
+        return server
+
+    def _session(self):
+        if self.server is not None and time.monotonic() - self.last_used > SMTP_IDLE_TIMEOUT:
+            self._close()
+        if self.server is None:
+            self.server = self._connect()
+        return self.server
+
+    def _close(self):
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self.server = None
+
+    def build_message(self, to, subject, body):
+        """A plain-text email from EMAIL_ADDRESS"""
+        msg = MIMEText(body)
+        msg['Subject'] = subject
+        msg['From'] = os.getenv('EMAIL_ADDRESS')
+        msg['To'] = to
+        return msg
+
+    def send_batch(self, messages):
+        """Send messages over the shared session; return {recipient: error or None}"""
+        results = {}
+        with self.lock:
+            for msg in messages:
+                try:
+                    try:
+                        self._session().send_message(msg)
+                    except smtplib.SMTPServerDisconnected:
+                        # The server closed the idle session; open a new one and retry once
+                        self.server = None
+                        self._session().send_message(msg)
+                    self.last_used = time.monotonic()
+                    results[msg['To']] = None
+                    print(f"✅ Email '{msg['Subject']}' sent to {msg['To']}")
+                except (smtplib.SMTPException, OSError) as e:
+                    results[msg['To']] = str(e)
+                    print(f"❌ Error sending email to {msg['To']}: {str(e)}")
+                    if not isinstance(e, smtplib.SMTPRecipientsRefused):
+                        self._close()
+        return results
+
+    async def send_batch_async(self, messages):
+        """Send a batch without blocking the job loop"""
+        return await asyncio.to_thread(self.send_batch, messages)
+
+    def send_later(self, messages):
+        """Queue a batch on the job runner and return its future"""
+        return job_runner.run(self.send_batch_async(messages))
+
+    def close(self):
+        """Quit the SMTP session, if one is open"""
+        with self.lock:
+            self._close()
+
+
+# Create a global instance
+mailer = Mailer()
@@ -1,35 +1,242 @@
 # reminder.py (WHATSAPP AS PRIMARY MESSAGING, UPDATED WITH STAFF TABLE, PASSWORD RESET, AND WINDOWS COMPATIBILITY)
 import sqlite3
 import datetime
-import urllib.request
 import urllib.parse
+import asyncio
 import json
-import time
 import os
+import re
+import secrets
 import shutil
+import threading
+import time
 import bcrypt
+import httpx
+from dataclasses import dataclass, asdict
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from itsdangerous import URLSafeTimedSerializer
 from dotenv import load_dotenv
+from jobs import job_runner
+from cache import TTLCache
+from limiter import AdaptiveLimiter
 
 # Load environment variables
 load_dotenv()
 
+# Database locations. ARCHIVE_DATABASE_PATH is optional: when set, archived
+# appointments live in a separate file ATTACHed as "archive"; otherwise they
+# stay in an appointments_archive table next to the hot table.
+DB_PATH = os.getenv('DATABASE_PATH', 'appointments.db')
+ARCHIVE_DB_PATH = os.getenv('ARCHIVE_DATABASE_PATH')
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '30'))
+ARCHIVE_TABLE = 'archive.appointments_archive' if ARCHIVE_DB_PATH else 'appointments_archive'
+
+# WhatsApp delivery settings
+CALLMEBOT_API_URL = os.getenv('CALLMEBOT_API_URL', 'https://api.callmebot.com/whatsapp.php')
+# Provider parallelism adapts between 1 and SEND_CONCURRENCY based on latency and errors
+SEND_CONCURRENCY = int(os.getenv('SEND_CONCURRENCY', '10'))
+SEND_INITIAL_CONCURRENCY = int(os.getenv('SEND_INITIAL_CONCURRENCY', '2'))
+SEND_TARGET_P95_MS = int(os.getenv('SEND_TARGET_P95_MS', '4000'))
+# Every send uses the same API key, so a rejected key pauses all sends for this long
+AUTH_ERROR_PAUSE_SECONDS = int(os.getenv('AUTH_ERROR_PAUSE_SECONDS', '300'))
+
+# Provider response classes recorded for every delivery attempt
+DELIVERY_QUEUED = 'queued'
+DELIVERY_SENT = 'sent'
+DELIVERY_RATE_LIMITED = 'rate_limited'
+DELIVERY_INVALID_RECIPIENT = 'invalid_recipient'
+DELIVERY_AUTH_ERROR = 'auth_error'
+DELIVERY_TRANSIENT = 'transient'
+DELIVERY_SUCCESS_STATUSES = (DELIVERY_QUEUED, DELIVERY_SENT)
+# Only an invalid number is permanent for its recipient; retrying it only burns quota
+DELIVERY_PERMANENT_STATUSES = (DELIVERY_INVALID_RECIPIENT,)
+# Failures that say the provider is struggling or rejecting our key, as opposed to
+# a bad recipient; the key is shared by every send, so an auth error is not the recipient's
+DELIVERY_BACKOFF_STATUSES = (DELIVERY_RATE_LIMITED, DELIVERY_TRANSIENT, DELIVERY_AUTH_ERROR)
+# A send cancelled mid-request may or may not have reached the recipient
+DELIVERY_UNKNOWN = 'unknown'
+# Kinds with one of these are not sent again; resending an unknown risks a duplicate
+DELIVERY_NO_RESEND_STATUSES = DELIVERY_SUCCESS_STATUSES + (DELIVERY_UNKNOWN,)
+# Inbound replies are recorded alongside the deliveries they answer
+DELIVERY_RECEIVED = 'received'
+
+# Staged reminder kinds; each staged row tracks its own send attempts
+REMINDER_KINDS = ('reminder_patient', 'reminder_doctor')
+# A reminder that failed with a backoff status is retried after
+# REMINDER_RETRY_SECONDS, doubling each time, for at most REMINDER_MAX_ATTEMPTS sends
+REMINDER_RETRY_SECONDS = int(os.getenv('REMINDER_RETRY_SECONDS', '300'))
+REMINDER_MAX_ATTEMPTS = int(os.getenv('REMINDER_MAX_ATTEMPTS', '4'))
+
+# Appointment status, changed by CONFIRM/CANCEL replies to reminders
+APPOINTMENT_SCHEDULED = 'scheduled'
+APPOINTMENT_CONFIRMED = 'confirmed'
+APPOINTMENT_CANCELLED = 'cancelled'
+
+# Each delivered reminder carries a reply token, so a reply is matched to its
+# message by one indexed lookup. No 0/O or 1/I, since people type it back.
+REPLY_TOKEN_ALPHABET = 'ABCDEFGHJKLMNPQRSTUVWXYZ23456789'
+REPLY_TOKEN_LENGTH = 8
+REPLY_PATTERN = re.compile(r'\b(CONFIRM|CANCEL)\b\W*([A-Z0-9]{%d})\b' % REPLY_TOKEN_LENGTH, re.IGNORECASE)
+
+def classify_provider_response(status_code, body):
+    """Classify a CallMeBot response into one of the DELIVERY_* statuses"""
+    text = body.lower()
+    if status_code == 429 or any(word in text for word in ['too many', 'rate limit', 'please wait']):
+        return DELIVERY_RATE_LIMITED
+    if status_code in (401, 403) or ('apikey' in text and any(word in text for word in ['invalid', 'not valid', 'need'])):
+        return DELIVERY_AUTH_ERROR
+    if 'phone' in text and any(word in text for word in ['invalid', 'not valid', 'not registered', 'not found']):
+        return DELIVERY_INVALID_RECIPIENT
+    if 'message queued' in text:
+        return DELIVERY_QUEUED
+    if 'message sent' in text or 'success' in text:
+        return DELIVERY_SENT
+    return DELIVERY_TRANSIENT
+
+# Status writes (deliveries, reminder flags) are committed in small batches
+STATUS_COMMIT_BATCH = int(os.getenv('STATUS_COMMIT_BATCH', '10'))
+STATUS_COMMIT_INTERVAL = float(os.getenv('STATUS_COMMIT_INTERVAL', '2'))
+
+# Reminders go out the day before, inside each recipient's local send window,
+# spread across it so no single minute carries the whole day's traffic
+DEFAULT_TIMEZONE = os.getenv('DEFAULT_TIMEZONE', 'Africa/Nairobi')
+SEND_WINDOW_START = os.getenv('SEND_WINDOW_START', '09:00')
+SEND_WINDOW_END = os.getenv('SEND_WINDOW_END', '19:00')
+UTC_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+# Booking: each appointment blocks its doctor for this long, within clinic hours
+APPOINTMENT_DURATION_MINUTES = int(os.getenv('APPOINTMENT_DURATION_MINUTES', '30'))
+CLINIC_OPEN = os.getenv('CLINIC_OPEN', '08:00')
+CLINIC_CLOSE = os.getenv('CLINIC_CLOSE', '17:00')
+
+# Staff records are revalidated on every request, so keep them cached in-process
+STAFF_CACHE_TTL = int(os.getenv('STAFF_CACHE_TTL', '300'))
+
+@dataclass(slots=True)
+class ReminderResult:
+    """Outcome of the patient and doctor reminders for one appointment"""
+    appointment_id: int
+    patient_name: str
+    doctor_name: str
+    patient_phone: str
+    doctor_phone: str
+    whatsapp_patient_success: bool
+    whatsapp_patient_message: str
+    whatsapp_doctor_success: bool
+    whatsapp_doctor_message: str
+
+    @property
+    def reminder_sent(self):
+        return self.whatsapp_patient_success and self.whatsapp_doctor_success
+
+    def to_dict(self):
+        result = asdict(self)
+        result['reminder_sent'] = self.reminder_sent
+        return result
+
 class ReminderSystem:
     def __init__(self):
         self.init_db()
         self.whatsapp_api_key = "7722049"
         self.secret_key = os.getenv('SECRET_KEY', 'medical-reminder-system-secret-key')
         self.serializer = URLSafeTimedSerializer(self.secret_key)
+        self.http_client = None
+        self.send_limiter = AdaptiveLimiter(initial=SEND_INITIAL_CONCURRENCY, maximum=SEND_CONCURRENCY,
+                                            target_p95_ms=SEND_TARGET_P95_MS)
+        self.staff_cache = TTLCache(ttl=STAFF_CACHE_TTL)
+        self.pending_writes = []
+        self.write_lock = threading.Lock()
+        self.last_flush = time.monotonic()
+        self.flush_timer = None
+        self.flush_task = None
+        # Held for a whole reminder run; a second run would pick up the same unsent rows
+        self.reminder_run_lock = threading.Lock()
         print(f"🔑 WhatsApp API Key loaded: {self.whatsapp_api_key}")
     
+    def connect(self, attach_archive=False):
+        """Open a connection to the appointments database"""
+        conn = sqlite3.connect(DB_PATH)
+        conn.row_factory = sqlite3.Row
+        if attach_archive and ARCHIVE_DB_PATH:
+            conn.execute('ATTACH DATABASE ? AS archive', (ARCHIVE_DB_PATH,))
+        return conn
+
+    def queue_write(self, query, params):
+        """Queue a status write; queued writes are committed together in small batches.
+
+        On the job loop a due batch is committed in a worker thread, so sends
+        keep going while SQLite writes.
+        """
+        with self.write_lock:
+            self.pending_writes.append((query, params))
+            due = (len(self.pending_writes) >= STATUS_COMMIT_BATCH
+                   or time.monotonic() - self.last_flush >= STATUS_COMMIT_INTERVAL)
+            # Commit the tail of a burst even if no further write arrives
+            self._schedule_flush()
+        if not due:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush_writes()
+            return
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = loop.run_in_executor(None, self.flush_writes)
+
+    def _schedule_flush(self):
+        # Caller holds write_lock
+        if self.flush_timer is None:
+            self.flush_timer = threading.Timer(STATUS_COMMIT_INTERVAL, self.flush_writes)
+            self.flush_timer.daemon = True
+            self.flush_timer.start()
+
+    def flush_writes(self):
+        """Commit every queued status write in one transaction.
+
+        A batch that fails (e.g. database is locked) is rolled back and put
+        back on the queue for a retry. If a write violates a constraint, the
+        batch is applied one write at a time and only the offending writes
+        are dropped.
+        """
+        with self.write_lock:
+            writes, self.pending_writes = self.pending_writes, []
+            self.last_flush = time.monotonic()
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            if not writes:
+                return
+            conn = self.connect()
+            try:
+                try:
+                    for query, params in writes:
+                        conn.execute(query, params)
+                    conn.commit()
+                except sqlite3.IntegrityError as e:
+                    conn.rollback()
+                    print(f"⚠️ Status write batch hit a constraint ({str(e)}); applying writes one at a time")
+                    for query, params in writes:
+                        try:
+                            conn.execute(query, params)
+                        except sqlite3.IntegrityError as e:
+                            print(f"❌ Dropped status write {params}: {str(e)}")
+                    conn.commit()
+            except sqlite3.Error as e:
+                conn.rollback()
+                self.pending_writes[:0] = writes
+                self._schedule_flush()
+                print(f"❌ Status write batch failed ({str(e)}); {len(writes)} writes requeued")
+            finally:
+                conn.close()
+
     def init_db(self):
         # Backup database before initialization
-        if os.path.exists('appointments.db'):
+        if os.path.exists(DB_PATH):
             backup_path = f"appointments_backup_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
-            shutil.copy('appointments.db', backup_path)
+            shutil.copy(DB_PATH, backup_path)
             print(f"📁 Database backed up to {backup_path}")
 
-        conn = sqlite3.connect('appointments.db')
+        conn = self.connect(attach_archive=True)
         c = conn.cursor()
         
         # Create appointments table
@@ -84,6 +291,169 @@ class ReminderSystem:
                 print(f"🔄 Adding {column} column to appointments table...")
                 c.execute(f'ALTER TABLE appointments ADD COLUMN {column} INTEGER DEFAULT 0')
         
+        c.execute("PRAGMA table_info(appointments)")
+        if 'timezone' not in [info[1] for info in c.fetchall()]:
+            print("🔄 Adding timezone column to appointments table...")
+            c.execute('ALTER TABLE appointments ADD COLUMN timezone TEXT')
+        
+        c.execute("PRAGMA table_info(appointments)")
+        if 'status' not in [info[1] for info in c.fetchall()]:
+            print("🔄 Adding status column to appointments table...")
+            c.execute(f"ALTER TABLE appointments ADD COLUMN status TEXT DEFAULT '{APPOINTMENT_SCHEDULED}'")
+        
+        # Hot-path lookups are by date; keep them off a full table scan
+        c.execute('CREATE INDEX IF NOT EXISTS idx_appointments_date ON appointments (appointment_date, appointment_time)')
+        # Conflict checks and free-slot lookups read one doctor's day at a time
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_appointments_doctor_schedule
+                     ON appointments (doctor_phone, appointment_date, appointment_time)''')
+        # The doctor's phone identifies them in those checks, so it is stored normalized
+        c.execute('SELECT DISTINCT doctor_phone FROM appointments WHERE doctor_phone IS NOT NULL')
+        for (doctor_phone,) in c.fetchall():
+            if self.normalize_phone(doctor_phone) != doctor_phone:
+                c.execute('UPDATE appointments SET doctor_phone = ? WHERE doctor_phone = ?',
+                          (self.normalize_phone(doctor_phone), doctor_phone))
+        
+        # Full-text index over names and phones, kept in sync by triggers
+        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='appointments_fts'")
+        fts_table_exists = c.fetchone()
+        c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS appointments_fts USING fts5
+                     (patient_name, doctor_name, patient_phone, doctor_phone,
+                      content='appointments', content_rowid='id')''')
+        c.execute('''CREATE TRIGGER IF NOT EXISTS appointments_fts_insert AFTER INSERT ON appointments BEGIN
+                       INSERT INTO appointments_fts (rowid, patient_name, doctor_name, patient_phone, doctor_phone)
+                       VALUES (new.id, new.patient_name, new.doctor_name, new.patient_phone, new.doctor_phone);
+                     END''')
+        c.execute('''CREATE TRIGGER IF NOT EXISTS appointments_fts_delete AFTER DELETE ON appointments BEGIN
+                       INSERT INTO appointments_fts (appointments_fts, rowid, patient_name, doctor_name, patient_phone, doctor_phone)
+                       VALUES ('delete', old.id, old.patient_name, old.doctor_name, old.patient_phone, old.doctor_phone);
+                     END''')
+        c.execute('''CREATE TRIGGER IF NOT EXISTS appointments_fts_update
+                     AFTER UPDATE OF patient_name, doctor_name, patient_phone, doctor_phone ON appointments BEGIN
+                       INSERT INTO appointments_fts (appointments_fts, rowid, patient_name, doctor_name, patient_phone, doctor_phone)
+                       VALUES ('delete', old.id, old.patient_name, old.doctor_name, old.patient_phone, old.doctor_phone);
+                       INSERT INTO appointments_fts (rowid, patient_name, doctor_name, patient_phone, doctor_phone)
+                       VALUES (new.id, new.patient_name, new.doctor_name, new.patient_phone, new.doctor_phone);
+                     END''')
+        if not fts_table_exists:
+            print("🔄 Building appointment search index...")
+            c.execute("INSERT INTO appointments_fts (appointments_fts) VALUES ('rebuild')")
+        
+        # Create deliveries table: one row per provider call
+        c.execute('''CREATE TABLE IF NOT EXISTS deliveries
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      appointment_id INTEGER,
+                      kind TEXT,
+                      phone TEXT,
+                      status TEXT,
+                      latency_ms INTEGER,
+                      response TEXT,
+                      created_at TEXT,
+                      token TEXT)''')
+        c.execute("PRAGMA table_info(deliveries)")
+        if 'token' not in [info[1] for info in c.fetchall()]:
+            c.execute('ALTER TABLE deliveries ADD COLUMN token TEXT')
+        c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_deliveries_token ON deliveries (token)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_deliveries_phone ON deliveries (phone)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_deliveries_appointment ON deliveries (appointment_id, kind)')
+        
+        # Create staging table for reminder messages rendered ahead of the send run.
+        # window_start/send_after/send_before are UTC: the recipient's local send
+        # window on send_date, and this message's spread-out slot within it.
+        c.execute("PRAGMA table_info(reminder_batches)")
+        batch_columns = [info[1] for info in c.fetchall()]
+        if batch_columns and 'send_after' not in batch_columns:
+            # Staged rows are derived data; re-stage them with send windows
+            print("🔄 Rebuilding reminder_batches with send windows...")
+            c.execute('DROP TABLE reminder_batches')
+        c.execute('''CREATE TABLE IF NOT EXISTS reminder_batches
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                      appointment_id INTEGER,
+                      kind TEXT,
+                      phone TEXT,
+                      message TEXT,
+                      send_date TEXT,
+                      window_start TEXT,
+                      send_after TEXT,
+                      send_before TEXT,
+                      created_at TEXT,
+                      attempts INTEGER DEFAULT 0,
+                      next_attempt_at TEXT,
+                      last_status TEXT,
+                      UNIQUE (appointment_id, kind))''')
+        c.execute("PRAGMA table_info(reminder_batches)")
+        if 'attempts' not in [info[1] for info in c.fetchall()]:
+            print("🔄 Adding send attempt tracking to reminder_batches...")
+            c.execute('ALTER TABLE reminder_batches ADD COLUMN attempts INTEGER DEFAULT 0')
+            c.execute('ALTER TABLE reminder_batches ADD COLUMN next_attempt_at TEXT')
+            c.execute('ALTER TABLE reminder_batches ADD COLUMN last_status TEXT')
+            # Rows sent before attempts were tracked keep their latest outcome
+            c.execute('''UPDATE reminder_batches SET last_status =
+                           (SELECT status FROM deliveries
+                            WHERE deliveries.appointment_id = reminder_batches.appointment_id
+                            AND deliveries.kind = reminder_batches.kind
+                            ORDER BY deliveries.id DESC LIMIT 1)''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_reminder_batches_due ON reminder_batches (send_after)')
+        # The same text to the same number on the same day is only staged once
+        c.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_reminder_batches_dedupe
+                     ON reminder_batches (send_date, phone, message)''')
+        # Staged rows go stale when their appointment changes or disappears
+        c.execute('DROP TRIGGER IF EXISTS reminder_batches_invalidate_update')
+        c.execute('''CREATE TRIGGER reminder_batches_invalidate_update
+                     AFTER UPDATE OF patient_name, patient_phone, doctor_name, doctor_phone,
+                                     appointment_date, appointment_time, timezone ON appointments BEGIN
+                       DELETE FROM reminder_batches WHERE appointment_id = old.id;
+                     END''')
+        c.execute('''CREATE TRIGGER IF NOT EXISTS reminder_batches_invalidate_delete
+                     AFTER DELETE ON appointments BEGIN
+                       DELETE FROM reminder_batches WHERE appointment_id = old.id;
+                     END''')
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS reminder_batches_invalidate_cancel
+                      AFTER UPDATE OF status ON appointments WHEN new.status = '{APPOINTMENT_CANCELLED}' BEGIN
+                        DELETE FROM reminder_batches WHERE appointment_id = old.id;
+                      END''')
+        
+        # Version counter bumped on every appointment change; list pages use it
+        # as their ETag so unchanged lists are revalidated without being rebuilt
+        c.execute('''CREATE TABLE IF NOT EXISTS data_versions
+                     (name TEXT PRIMARY KEY,
+                      version INTEGER)''')
+        c.execute("INSERT OR IGNORE INTO data_versions (name, version) VALUES ('appointments', 1)")
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            c.execute(f'''CREATE TRIGGER IF NOT EXISTS appointments_version_{event.lower()}
+                          AFTER {event} ON appointments BEGIN
+                            UPDATE data_versions SET version = version + 1 WHERE name = 'appointments';
+                          END''')
+        
+        # Create tables for background jobs and their per-appointment results
+        c.execute('''CREATE TABLE IF NOT EXISTS jobs
+                     (id TEXT PRIMARY KEY,
+                      name TEXT,
+                      status TEXT,
+                      created_at TEXT,
+                      finished_at TEXT,
+                      error TEXT)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS job_results
+                     (job_id TEXT,
+                      seq INTEGER,
+                      result TEXT,
+                      PRIMARY KEY (job_id, seq))''')
+        # Jobs still running when the process stopped will never finish
+        c.execute("UPDATE jobs SET status = 'interrupted' WHERE status = 'running'")
+        
+        # Create archive table for appointments past the archive horizon
+        c.execute(f'''CREATE TABLE IF NOT EXISTS {ARCHIVE_TABLE}
+                     (id INTEGER PRIMARY KEY,
+                      patient_name TEXT,
+                      patient_phone TEXT,
+                      doctor_name TEXT,
+                      doctor_phone TEXT,
+                      appointment_date TEXT,
+                      appointment_time TEXT,
+                      reminder_sent INTEGER DEFAULT 0,
+                      whatsapp_sent INTEGER DEFAULT 0,
+                      confirmation_sent INTEGER DEFAULT 0,
+                      archived_at TEXT)''')
+        
         conn.commit()
         conn.close()
         print("✅ Database initialized with appointments and staff tables")
@@ -92,12 +462,13 @@ class ReminderSystem:
         """Add a new staff member with hashed password"""
         try:
             hashed = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
-            conn = sqlite3.connect('appointments.db')
+            conn = self.connect()
             c = conn.cursor()
             c.execute('INSERT INTO staff (username, password_hash, email) VALUES (?, ?, ?)',
                      (username, hashed, email))
             conn.commit()
             conn.close()
+            self.staff_cache.clear()
             print(f"✅ Staff added: {username}")
             return True
         except sqlite3.IntegrityError:
@@ -109,7 +480,7 @@ class ReminderSystem:
 
     def validate_staff(self, username, password):
         """Validate staff credentials"""
-        conn = sqlite3.connect('appointments.db')
+        conn = self.connect()
         c = conn.cursor()
         c.execute('SELECT password_hash FROM staff WHERE username = ?', (username,))
         result = c.fetchone()
@@ -122,25 +493,39 @@ class ReminderSystem:
 
     def get_all_staff(self):
         """Retrieve all staff members"""
-        conn = sqlite3.connect('appointments.db')
+        return self.staff_cache.get('all', lambda: self._fetch_staff('SELECT id, username, email FROM staff'))
+
+    def get_staff_by_id(self, staff_id):
+        """Retrieve a staff member by id, or None"""
+        return self.staff_cache.get(('id', staff_id), lambda: self._fetch_staff(
+            'SELECT id, username, email FROM staff WHERE id = ?', (staff_id,), one=True))
+
+    def get_staff_by_username(self, username):
+        """Retrieve a staff member by username, or None"""
+        return self.staff_cache.get(('username', username), lambda: self._fetch_staff(
+            'SELECT id, username, email FROM staff WHERE username = ?', (username,), one=True))
+
+    def _fetch_staff(self, query, params=(), one=False):
+        conn = self.connect()
         c = conn.cursor()
-        c.execute('SELECT id, username, email FROM staff')
-        staff = c.fetchall()
+        c.execute(query, params)
+        staff = c.fetchone() if one else c.fetchall()
         conn.close()
         return staff
 
     def delete_staff(self, staff_id):
         """Delete a staff member"""
-        conn = sqlite3.connect('appointments.db')
+        conn = self.connect()
         c = conn.cursor()
         c.execute('DELETE FROM staff WHERE id = ?', (staff_id,))
         conn.commit()
         conn.close()
+        self.staff_cache.clear()
         print(f"✅ Staff ID {staff_id} deleted")
 
     def get_staff_by_email(self, email):
         """Retrieve staff by email for password reset"""
-        conn = sqlite3.connect('appointments.db')
+        conn = self.connect()
         c = conn.cursor()
         c.execute('SELECT id, username FROM staff WHERE email = ?', (email,))
         staff = c.fetchone()
@@ -163,38 +548,108 @@ class ReminderSystem:
         """Update staff password"""
         try:
             hashed = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt())
-            conn = sqlite3.connect('appointments.db')
+            conn = self.connect()
             c = conn.cursor()
             c.execute('UPDATE staff SET password_hash = ? WHERE username = ?', (hashed, username))
             conn.commit()
             conn.close()
+            self.staff_cache.invalidate(('username', username))
             print(f"✅ Password reset for {username}")
             return True
         except Exception as e:
             print(f"❌ Error resetting password: {str(e)}")
             return False
 
-    def add_appointment(self, patient_name, patient_phone, doctor_name, doctor_phone, appointment_date, appointment_time):
-        conn = sqlite3.connect('appointments.db')
+    def create_job(self, job_id, name, created_at):
+        """Record a newly started background job"""
+        conn = self.connect()
         c = conn.cursor()
-        c.execute('''INSERT INTO appointments 
-                     (patient_name, patient_phone, doctor_name, doctor_phone, appointment_date, appointment_time)
-                     VALUES (?, ?, ?, ?, ?, ?)''',
-                     (patient_name, patient_phone, doctor_name, doctor_phone, appointment_date, appointment_time))
+        c.execute("INSERT INTO jobs (id, name, status, created_at) VALUES (?, ?, 'running', ?)",
+                  (job_id, name, created_at))
         conn.commit()
         conn.close()
+
+    def save_job_result(self, job_id, seq, result):
+        """Record one result of a background job; it is committed with the next status write batch"""
+        self.queue_write('INSERT INTO job_results (job_id, seq, result) VALUES (?, ?, ?)',
+                         (job_id, seq, json.dumps(result.to_dict())))
+
+    def finish_job(self, job_id, status, finished_at, error=None):
+        """Record the final state of a background job, after all of its results"""
+        self.flush_writes()
+        conn = self.connect()
+        c = conn.cursor()
+        c.execute('UPDATE jobs SET status = ?, finished_at = ?, error = ? WHERE id = ?',
+                  (status, finished_at, error, job_id))
+        conn.commit()
+        conn.close()
+
+    def get_job(self, job_id, since=0):
+        """Retrieve a background job with its results after the first `since`"""
+        conn = self.connect()
+        c = conn.cursor()
+        c.execute('SELECT id, name, status, created_at, finished_at, error FROM jobs WHERE id = ?', (job_id,))
+        row = c.fetchone()
+        if row is None:
+            conn.close()
+            return None
+        c.execute('SELECT result FROM job_results WHERE job_id = ? AND seq > ? ORDER BY seq', (job_id, since))
+        results = [json.loads(result['result']) for result in c.fetchall()]
+        conn.close()
+        return dict(row, results=results)
+
+    def add_appointment(self, patient_name, patient_phone, doctor_name, doctor_phone, appointment_date, appointment_time,
+                        timezone=None):
+        timezone = timezone or DEFAULT_TIMEZONE
+        self.get_timezone(timezone)  # Reject unknown timezones before booking
+        patient_phone = self.normalize_phone(patient_phone)
+        doctor_phone = self.normalize_phone(doctor_phone)
+        
+        # Check and insert under one write lock, so concurrent bookings of the same slot can't both pass
+        conn = self.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            if self.find_conflicts(doctor_phone, appointment_date, appointment_time, conn):
+                raise ValueError(f"Dr. {doctor_name} already has an appointment within "
+                                 f"{APPOINTMENT_DURATION_MINUTES} minutes of {appointment_time} on {appointment_date}")
+            c = conn.cursor()
+            c.execute('''INSERT INTO appointments 
+                         (patient_name, patient_phone, doctor_name, doctor_phone, appointment_date, appointment_time, timezone)
+                         VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                         (patient_name, patient_phone, doctor_name, doctor_phone, appointment_date, appointment_time, timezone))
+            appointment_id = c.lastrowid
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        
+        # Render its reminders now, off the morning send path
+        self.precompute_reminders(appointment_id=appointment_id)
         
         print(f"✅ Appointment added: {patient_name} with Dr. {doctor_name} on {appointment_date} at {appointment_time}")
         
-        # Send immediate WhatsApp confirmation
-        self.send_appointment_confirmation(patient_name, patient_phone, doctor_name, doctor_phone, appointment_date, appointment_time)
+        # Send WhatsApp confirmation in the background so booking doesn't wait on the provider
+        job_runner.run(self.send_appointment_confirmation(appointment_id))
         
         return True
 
-    def send_appointment_confirmation(self, patient_name, patient_phone, doctor_name, doctor_phone, appointment_date, appointment_time):
+    async def send_appointment_confirmation(self, appointment_id):
         """Send immediate WhatsApp confirmation when appointment is created"""
         print(f"\n💬 SENDING APPOINTMENT CONFIRMATION VIA WHATSAPP")
         
+        appointment = await asyncio.to_thread(self.get_appointment, appointment_id)
+        if appointment is None:
+            print(f"❌ Appointment {appointment_id} no longer exists")
+            return False
+        patient_name = appointment['patient_name']
+        patient_phone = appointment['patient_phone']
+        doctor_name = appointment['doctor_name']
+        doctor_phone = appointment['doctor_phone']
+        appointment_date = appointment['appointment_date']
+        appointment_time = appointment['appointment_time']
+        
         # Format date for better readability
         formatted_date = datetime.datetime.strptime(appointment_date, '%Y-%m-%d').strftime('%B %d, %Y')
         
@@ -227,116 +682,539 @@ Please confirm your availability. 🏥"""
 
         # Send to patient
         print(f"👤 Sending confirmation to patient: {patient_name}")
-        patient_success, patient_msg = self.send_whatsapp_message(patient_phone, patient_message)
-        
-        time.sleep(2)  # Brief delay
+        patient_success, patient_msg = await self.send_whatsapp_message_async(
+            patient_phone, patient_message, appointment_id, 'confirmation_patient')
         
         # Send to doctor
         print(f"👨‍⚕️ Sending notification to doctor: Dr. {doctor_name}")
-        doctor_success, doctor_msg = self.send_whatsapp_message(doctor_phone, doctor_message)
+        doctor_success, doctor_msg = await self.send_whatsapp_message_async(
+            doctor_phone, doctor_message, appointment_id, 'confirmation_doctor')
         
         # Update database if confirmations were sent
         if patient_success or doctor_success:
-            conn = sqlite3.connect('appointments.db')
-            c = conn.cursor()
-            # Find the latest appointment for this patient/doctor combination
-            c.execute('''SELECT id FROM appointments 
-                         WHERE patient_name = ? AND doctor_name = ? AND appointment_date = ? AND appointment_time = ?
-                         ORDER BY id DESC LIMIT 1''',
-                         (patient_name, doctor_name, appointment_date, appointment_time))
-            appointment = c.fetchone()
-            if appointment:
-                c.execute('UPDATE appointments SET confirmation_sent = 1 WHERE id = ?', (appointment[0],))
-                conn.commit()
-            conn.close()
+            self.queue_write('UPDATE appointments SET confirmation_sent = 1 WHERE id = ?', (appointment_id,))
         
+        await asyncio.to_thread(self.flush_writes)
         return patient_success and doctor_success
 
-    def get_all_appointments(self):
-        conn = sqlite3.connect('appointments.db')
+    def get_appointment(self, appointment_id):
+        """Fetch one appointment row, or None if it no longer exists"""
+        conn = self.connect()
+        c = conn.cursor()
+        c.execute('SELECT * FROM appointments WHERE id = ?', (appointment_id,))
+        appointment = c.fetchone()
+        conn.close()
+        return appointment
+
+    def get_timezone(self, name):
+        """ZoneInfo for an IANA timezone name, raising ValueError if it is unknown"""
+        try:
+            return ZoneInfo(name or DEFAULT_TIMEZONE)
+        except (ZoneInfoNotFoundError, ValueError):
+            raise ValueError(f"Unknown timezone: {name}")
+
+    def send_window(self, appointment):
+        """UTC (window_start, send_after, send_before) for an appointment's reminders.
+
+        The window is SEND_WINDOW_START-SEND_WINDOW_END on the day before the
+        appointment, in the appointment's timezone. Each appointment gets a
+        fixed, evenly spread slot within it.
+        """
+        tz = self.get_timezone(appointment['timezone'])
+        send_date = (datetime.datetime.strptime(appointment['appointment_date'], '%Y-%m-%d')
+                     - datetime.timedelta(days=1)).date()
+        start = datetime.datetime.combine(
+            send_date, datetime.datetime.strptime(SEND_WINDOW_START, '%H:%M').time(), tzinfo=tz)
+        end = datetime.datetime.combine(
+            send_date, datetime.datetime.strptime(SEND_WINDOW_END, '%H:%M').time(), tzinfo=tz)
+        # Golden-ratio spacing spreads consecutive ids evenly over the window
+        spread = (appointment['id'] * 0.6180339887) % 1
+        send_after = start + (end - start) * spread
+        return tuple(moment.astimezone(datetime.timezone.utc).strftime(UTC_FORMAT)
+                     for moment in (start, send_after, end))
+
+    def find_conflicts(self, doctor_phone, appointment_date, appointment_time, conn=None):
+        """Appointments of this doctor that overlap a booking at the given date and time.
+
+        Pass conn to check inside a caller's transaction.
+        """
+        start = datetime.datetime.strptime(appointment_time[:5], '%H:%M')
+        overlap = datetime.timedelta(minutes=APPOINTMENT_DURATION_MINUTES - 1)
+        earliest = max(start - overlap, start.replace(hour=0, minute=0)).strftime('%H:%M')
+        latest = min(start + overlap, start.replace(hour=23, minute=59)).strftime('%H:%M')
+        
+        own_conn = conn is None
+        conn = conn or self.connect()
+        c = conn.cursor()
+        c.execute('''SELECT * FROM appointments
+                     WHERE doctor_phone = ? AND appointment_date = ? AND appointment_time BETWEEN ? AND ?
+                     AND status IS NOT ?''',
+                  (self.normalize_phone(doctor_phone), appointment_date, earliest, latest, APPOINTMENT_CANCELLED))
+        conflicts = c.fetchall()
+        if own_conn:
+            conn.close()
+        return conflicts
+
+    def find_free_slots(self, doctor_phone, appointment_date, day_start=CLINIC_OPEN, day_end=CLINIC_CLOSE):
+        """Start times between day_start and day_end at which the doctor can still be booked"""
+        conn = self.connect()
+        c = conn.cursor()
+        c.execute('''SELECT appointment_time FROM appointments
+                     WHERE doctor_phone = ? AND appointment_date = ? AND status IS NOT ?
+                     ORDER BY appointment_time''',
+                  (self.normalize_phone(doctor_phone), appointment_date, APPOINTMENT_CANCELLED))
+        booked = [datetime.datetime.strptime(row['appointment_time'][:5], '%H:%M') for row in c.fetchall()]
+        conn.close()
+        
+        duration = datetime.timedelta(minutes=APPOINTMENT_DURATION_MINUTES)
+        slot = datetime.datetime.strptime(day_start, '%H:%M')
+        close = datetime.datetime.strptime(day_end, '%H:%M')
+        free_slots = []
+        i = 0
+        # Walk the slot grid and the sorted bookings together
+        while slot + duration <= close:
+            while i < len(booked) and booked[i] + duration <= slot:
+                i += 1
+            if i == len(booked) or booked[i] >= slot + duration:
+                free_slots.append(slot.strftime('%H:%M'))
+            slot += duration
+        return free_slots
+
+    def get_schedule(self, appointment_date):
+        """All appointments on a date, by time and doctor"""
+        conn = self.connect()
+        c = conn.cursor()
+        c.execute('''SELECT * FROM appointments WHERE appointment_date = ?
+                     ORDER BY appointment_time, doctor_name''', (appointment_date,))
+        appointments = c.fetchall()
+        conn.close()
+        return appointments
+
+    def get_data_version(self, name='appointments'):
+        """Counter that changes whenever the named data does"""
+        conn = self.connect()
+        c = conn.cursor()
+        c.execute('SELECT version FROM data_versions WHERE name = ?', (name,))
+        row = c.fetchone()
+        conn.close()
+        return row['version'] if row else None
+
+    def get_all_appointments(self, include_archived=False):
+        """Get current appointments, optionally followed by archived ones"""
+        conn = self.connect()
         c = conn.cursor()
         c.execute('''SELECT * FROM appointments ORDER BY appointment_date, appointment_time''')
         appointments = c.fetchall()
         conn.close()
+        if include_archived:
+            appointments = self.get_archived_appointments() + appointments
         return appointments
 
-    def get_tomorrows_appointments(self):
-        """Get appointments for tomorrow specifically"""
-        conn = sqlite3.connect('appointments.db')
+    def get_archived_appointments(self):
+        """Get appointments that have been moved to the archive"""
+        conn = self.connect(attach_archive=True)
         c = conn.cursor()
+        c.execute(f'''SELECT {', '.join(self._sync_archive_columns(c))} FROM {ARCHIVE_TABLE}
+                      ORDER BY appointment_date, appointment_time''')
+        appointments = c.fetchall()
+        conn.close()
+        return appointments
+
+    def _appointment_columns(self, c):
+        """Column names of the appointments table, in table order"""
+        c.execute('PRAGMA table_info(appointments)')
+        return [info[1] for info in c.fetchall()]
+
+    def _sync_archive_columns(self, c):
+        """Add hot-table columns missing from the archive; return the hot table's columns"""
+        columns = self._appointment_columns(c)
+        archive_schema = 'archive.' if ARCHIVE_DB_PATH else ''
+        c.execute(f"PRAGMA {archive_schema}table_info(appointments_archive)")
+        archive_columns = [info[1] for info in c.fetchall()]
+        for column in columns:
+            if column not in archive_columns:
+                c.execute(f'ALTER TABLE {ARCHIVE_TABLE} ADD COLUMN {column}')
+        return columns
+
+    def archive_old_appointments(self, days=None):
+        """Move appointments older than the archive horizon out of the hot table"""
+        days = ARCHIVE_AFTER_DAYS if days is None else days
+        cutoff = (datetime.datetime.now() - datetime.timedelta(days=days)).date().isoformat()
         
-        # Calculate tomorrow's date
-        tomorrow = (datetime.datetime.now() + datetime.timedelta(days=1)).date().isoformat()
+        conn = self.connect(attach_archive=True)
+        c = conn.cursor()
         
-        print(f"📅 Looking for appointments on: {tomorrow}")
+        # Archive schema follows the hot table as columns are added to it
+        columns = self._sync_archive_columns(c)
+        column_list = ', '.join(columns)
+        c.execute(f'''INSERT OR REPLACE INTO {ARCHIVE_TABLE} ({column_list}, archived_at)
+                      SELECT {column_list}, ? FROM appointments WHERE appointment_date < ?''',
+                  (datetime.datetime.now().isoformat(timespec='seconds'), cutoff))
+        archived = c.rowcount
+        c.execute('DELETE FROM appointments WHERE appointment_date < ?', (cutoff,))
+        conn.commit()
+        conn.close()
         
-        c.execute('''SELECT * FROM appointments 
-                     WHERE appointment_date = ? AND reminder_sent = 0''', (tomorrow,))
+        print(f"📦 Archived {archived} appointments dated before {cutoff}")
+        return archived
+
+    def search_appointments(self, query, page=1, per_page=20):
+        """Full-text search on patient/doctor names and phones.
+
+        Every word in the query is matched as a prefix; results are ranked
+        by bm25 and paginated. Returns (appointments, total_matches).
+        """
+        terms = re.findall(r'\w+', query)
+        if not terms:
+            return [], 0
+        match = ' '.join(f'"{term}"*' for term in terms)
+        
+        conn = self.connect()
+        c = conn.cursor()
+        c.execute('SELECT count(*) FROM appointments_fts WHERE appointments_fts MATCH ?', (match,))
+        total = c.fetchone()[0]
+        c.execute('''SELECT appointments.* FROM appointments_fts
+                     JOIN appointments ON appointments.id = appointments_fts.rowid
+                     WHERE appointments_fts MATCH ?
+                     ORDER BY bm25(appointments_fts) LIMIT ? OFFSET ?''',
+                  (match, per_page, (page - 1) * per_page))
         appointments = c.fetchall()
         conn.close()
-        return appointments
+        return appointments, total
+
+    def _iter_appointment_pages(self, page_size=500, appointment_date=None, unstaged_only=False):
+        appointment_date = appointment_date or (datetime.datetime.now() + datetime.timedelta(days=1)).date().isoformat()
+        unstaged_filter = (' AND NOT EXISTS (SELECT 1 FROM reminder_batches'
+                           ' WHERE reminder_batches.appointment_id = appointments.id)') if unstaged_only else ''
+        
+        last_id = 0
+        while True:
+            conn = self.connect()
+            c = conn.cursor()
+            c.execute(f'''SELECT * FROM appointments
+                          WHERE appointment_date = ? AND reminder_sent = 0 AND status IS NOT ?
+                          AND id > ?{unstaged_filter}
+                          ORDER BY id LIMIT ?''', (appointment_date, APPOINTMENT_CANCELLED, last_id, page_size))
+            page = c.fetchall()
+            conn.close()
+            if not page:
+                return
+            yield page
+            last_id = page[-1]['id']
+
+    def render_reminder_messages(self, appointment):
+        """Reminder texts for an appointment as {kind: (phone, message)}"""
+        patient_name = appointment['patient_name'] or 'Unknown'
+        doctor_name = appointment['doctor_name'] or 'Unknown'
+        appt_time = appointment['appointment_time']
+        
+        # Format date for better readability
+        formatted_date = datetime.datetime.strptime(appointment['appointment_date'], '%Y-%m-%d').strftime('%B %d, %Y')
+        
+        # Patient reminder message
+        patient_message = f"""💊 *Appointment Reminder*
+
+Hello {patient_name},
+
+This is a friendly reminder about your appointment tomorrow:
+
+*Doctor:* Dr. {doctor_name}
+*Date:* {formatted_date}
+*Time:* {appt_time}
+
+Please bring any relevant medical reports or medications. 🏥"""
+
+        # Doctor reminder message
+        doctor_message = f"""💊 *Appointment Reminder*
+
+Hello Dr. {doctor_name},
+
+Reminder: You have an appointment tomorrow:
+
+*Patient:* {patient_name}
+*Date:* {formatted_date}
+*Time:* {appt_time}
+*Patient Phone:* {appointment['patient_phone'] or ''}
+
+Please confirm your schedule. 🏥"""
+
+        return {
+            'reminder_patient': (appointment['patient_phone'] or '', patient_message),
+            'reminder_doctor': (appointment['doctor_phone'] or '', doctor_message)
+        }
+
+    def precompute_reminders(self, appointment_date=None, appointment_id=None):
+        """Stage rendered, normalized reminder messages ahead of the send run.
+
+        Stages one appointment, or every unstaged appointment on
+        appointment_date. By default that is tomorrow and the day after, which
+        covers every timezone whose send window can open before the next run.
+        Already staged rows and duplicate texts to the same number are skipped.
+        """
+        if appointment_id is not None:
+            conn = self.connect()
+            c = conn.cursor()
+            c.execute('SELECT * FROM appointments WHERE id = ?', (appointment_id,))
+            pages = [c.fetchall()]
+            conn.close()
+        else:
+            today = datetime.date.today()
+            dates = [appointment_date] if appointment_date else [
+                (today + datetime.timedelta(days=days)).isoformat() for days in (1, 2)]
+            pages = (page for date in dates
+                     for page in self._iter_appointment_pages(appointment_date=date, unstaged_only=True))
+            # Rows whose send window closed over a day ago are no longer needed
+            conn = self.connect()
+            conn.execute('DELETE FROM reminder_batches WHERE send_before < ?',
+                         ((datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=1)).strftime(UTC_FORMAT),))
+            conn.commit()
+            conn.close()
+        
+        created_at = datetime.datetime.now().isoformat(timespec='seconds')
+        staged = 0
+        for page in pages:
+            rows = []
+            for appointment in page:
+                send_date = (datetime.datetime.strptime(appointment['appointment_date'], '%Y-%m-%d')
+                             - datetime.timedelta(days=1)).date().isoformat()
+                window_start, send_after, send_before = self.send_window(appointment)
+                for kind, (phone, message) in self.render_reminder_messages(appointment).items():
+                    rows.append((appointment['id'], kind, self.normalize_phone(phone), message, send_date,
+                                 window_start, send_after, send_before, created_at))
+            conn = self.connect()
+            c = conn.cursor()
+            c.executemany('''INSERT OR IGNORE INTO reminder_batches
+                             (appointment_id, kind, phone, message, send_date,
+                              window_start, send_after, send_before, created_at)
+                             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+            staged += c.rowcount
+            # An appointment whose every message repeats one already staged has
+            # nothing left to send, and would never come due; it is covered
+            ids = [appointment['id'] for appointment in page]
+            c.execute(f'''UPDATE appointments SET reminder_sent = 1, whatsapp_sent = 1
+                          WHERE id IN ({', '.join('?' * len(ids))}) AND reminder_sent = 0
+                          AND id NOT IN (SELECT appointment_id FROM reminder_batches)''', ids)
+            conn.commit()
+            conn.close()
+        
+        if appointment_id is None and staged:
+            print(f"🗂️ Staged {staged} new reminder messages")
+        return staged
+
+    def iter_staged_reminders(self, page_size=500, ignore_spread=False):
+        """Yield (appointment, {kind: staged row}) for unreminded appointments that are due now.
+
+        A row is due once its spread-out slot has started and its send window
+        has not closed; with ignore_spread, as soon as the window has opened.
+        A row that failed is only due again once its retry backoff has passed
+        and while it has attempts left; delivered rows and rows for
+        permanently failing recipients are never due. Each staged row carries
+        a `due` flag.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc).strftime(UTC_FORMAT)
+        opens_column = 'window_start' if ignore_spread else 'send_after'
+        due = f'''{opens_column} <= ? AND send_before >= ? AND attempts < ?
+                  AND (last_status IS NULL OR last_status IN ({', '.join('?' * len(DELIVERY_BACKOFF_STATUSES))}))
+                  AND (next_attempt_at IS NULL OR next_attempt_at <= ?)'''
+        due_params = (now, now, REMINDER_MAX_ATTEMPTS, *DELIVERY_BACKOFF_STATUSES, now)
+        
+        last_id = 0
+        while True:
+            conn = self.connect()
+            c = conn.cursor()
+            c.execute(f'''SELECT * FROM appointments
+                          WHERE reminder_sent = 0 AND status IS NOT ? AND id > ? AND id IN
+                            (SELECT appointment_id FROM reminder_batches WHERE {due})
+                          ORDER BY id LIMIT ?''', (APPOINTMENT_CANCELLED, last_id, *due_params, page_size))
+            page = c.fetchall()
+            if not page:
+                conn.close()
+                return
+            ids = [appointment['id'] for appointment in page]
+            c.execute(f'''SELECT *, ({due}) AS due FROM reminder_batches
+                          WHERE appointment_id IN ({', '.join('?' * len(ids))})''', (*due_params, *ids))
+            staged = {}
+            for row in c.fetchall():
+                staged.setdefault(row['appointment_id'], {})[row['kind']] = row
+            conn.close()
+            for appointment in page:
+                yield appointment, staged.get(appointment['id'], {})
+            last_id = page[-1]['id']
 
     def delete_appointment(self, appointment_id):
-        conn = sqlite3.connect('appointments.db')
+        conn = self.connect()
         c = conn.cursor()
         c.execute('DELETE FROM appointments WHERE id = ?', (appointment_id,))
         conn.commit()
         conn.close()
 
-    def safe_get_appointment_data(self, appointment):
-        """Safely extract appointment data with defaults"""
-        return {
-            'id': appointment[0] if len(appointment) > 0 else None,
-            'patient_name': appointment[1] if len(appointment) > 1 else 'Unknown',
-            'patient_phone': appointment[2] if len(appointment) > 2 else '',
-            'doctor_name': appointment[3] if len(appointment) > 3 else 'Unknown',
-            'doctor_phone': appointment[4] if len(appointment) > 4 else '',
-            'appointment_date': appointment[5] if len(appointment) > 5 else '',
-            'appointment_time': appointment[6] if len(appointment) > 6 else '',
-            'reminder_sent': appointment[7] if len(appointment) > 7 else 0,
-            'whatsapp_sent': appointment[8] if len(appointment) > 8 else 0,
-            'confirmation_sent': appointment[9] if len(appointment) > 9 else 0
-        }
+    def normalize_phone(self, phone_number):
+        """Phone number in the +<digits> form sent to the provider"""
+        clean_phone = phone_number.replace(' ', '').replace('-', '')
+        if not clean_phone.startswith('+'):
+            clean_phone = '+' + clean_phone
+        return clean_phone
 
-    def send_whatsapp_message(self, phone_number, message):
-        """Send message via WhatsApp API"""
+    def whatsapp_url(self, phone_number, message):
+        """Build the CallMeBot request URL for a message"""
+        clean_phone = self.normalize_phone(phone_number)
+        
+        # URL encode message
+        encoded_message = urllib.parse.quote(message)
+        
+        return f"{CALLMEBOT_API_URL}?phone={clean_phone}&text={encoded_message}&apikey={self.whatsapp_api_key}"
+
+    def get_http_client(self):
+        """Shared HTTP client for provider calls, bound to the job loop"""
+        if self.http_client is None:
+            self.http_client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=SEND_CONCURRENCY * 2))
+        return self.http_client
+
+    async def send_whatsapp_message_async(self, phone_number, message, appointment_id=None, kind='manual',
+                                          token=None):
+        """Send message via WhatsApp API without blocking the event loop"""
+        # Wait for a slot under the adaptive concurrency limit
+        await self.send_limiter.acquire()
+        status = latency_ms = None
+        started = time.monotonic()
         try:
-            # Clean phone number
-            clean_phone = phone_number.replace(' ', '').replace('-', '')
-            if not clean_phone.startswith('+'):
-                clean_phone = '+' + clean_phone
-            
-            # URL encode message
-            encoded_message = urllib.parse.quote(message)
-            
-            # Build URL
-            url = f"https://api.callmebot.com/whatsapp.php?phone={clean_phone}&text={encoded_message}&apikey={self.whatsapp_api_key}"
+            url = self.whatsapp_url(phone_number, message)
             
             print(f"📡 WhatsApp API URL: {url}")
             
             # Send request
-            req = urllib.request.Request(url)
-            with urllib.request.urlopen(req, timeout=30) as response:
-                result = response.read().decode()
+            response = await self.get_http_client().get(url, timeout=self.send_limiter.timeout())
+            result = response.text
+            status = classify_provider_response(response.status_code, result)
             
-            print(f"📨 API Response: {result}")
+            print(f"📨 API Response ({status}): {result}")
+            if status == DELIVERY_AUTH_ERROR and self.send_limiter.pause(AUTH_ERROR_PAUSE_SECONDS):
+                print(f"🔑 Provider rejected the WhatsApp API key; pausing all sends for {AUTH_ERROR_PAUSE_SECONDS}s")
             
-            # Check if successful
-            if any(success_word in result.lower() for success_word in ['message queued', 'message sent', 'success']):
-                return True, "WhatsApp message sent successfully! ✅"
+            if status in DELIVERY_SUCCESS_STATUSES:
+                result_msg = "WhatsApp message sent successfully! ✅"
             else:
-                return False, f"WhatsApp API: {result}"
+                result_msg = f"WhatsApp API ({status}): {result}"
                 
+        except asyncio.CancelledError:
+            # The provider may already have the message; record it so it isn't resent blindly
+            self.record_delivery(appointment_id, kind, self.normalize_phone(phone_number), DELIVERY_UNKNOWN,
+                                 None, 'Cancelled while the request was in flight', token)
+            raise
         except Exception as e:
-            return False, f"WhatsApp error: {str(e)}"
+            result = result_msg = f"WhatsApp error: {str(e)}"
+            status = DELIVERY_TRANSIENT
+        finally:
+            # A cancelled call frees its slot without counting as a sample
+            if status is not None:
+                latency_ms = int((time.monotonic() - started) * 1000)
+            await self.send_limiter.release(latency_ms, status in DELIVERY_BACKOFF_STATUSES)
+        
+        # Only a delivered message can be replied to, so only it keeps its reply token
+        success = status in DELIVERY_SUCCESS_STATUSES
+        self.record_delivery(appointment_id, kind, self.normalize_phone(phone_number), status, latency_ms, result,
+                             token if success else None)
+        return success, result_msg
+
+    def record_delivery(self, appointment_id, kind, phone, status, latency_ms, response, token=None):
+        """Record the outcome of one provider call"""
+        self.queue_write('''INSERT INTO deliveries (appointment_id, kind, phone, status, latency_ms, response, created_at, token)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                         (appointment_id, kind, phone, status, latency_ms, response,
+                          datetime.datetime.now().isoformat(timespec='seconds'), token))
+        if kind in REMINDER_KINDS:
+            # A backoff failure is due again after REMINDER_RETRY_SECONDS, doubled per attempt made
+            self.queue_write('''UPDATE reminder_batches SET attempts = attempts + 1, last_status = ?,
+                                next_attempt_at = CASE WHEN ? THEN
+                                  strftime('%Y-%m-%dT%H:%M:%S', 'now', (? << attempts) || ' seconds') END
+                                WHERE appointment_id = ? AND kind = ?''',
+                             (status, status in DELIVERY_BACKOFF_STATUSES, REMINDER_RETRY_SECONDS,
+                              appointment_id, kind))
+
+    def retry_state(self, row):
+        """Why a staged reminder that was not delivered is not being sent now"""
+        if row['last_status'] not in DELIVERY_BACKOFF_STATUSES:
+            return f"Not sent: recipient failing permanently ({row['last_status']})"
+        if row['attempts'] >= REMINDER_MAX_ATTEMPTS:
+            return f"Gave up after {row['attempts']} attempts ({row['last_status']})"
+        return f"Retrying after {row['next_attempt_at']} UTC ({row['last_status']})"
+
+    def new_reply_token(self):
+        """Random token identifying one outgoing message in replies to it"""
+        return ''.join(secrets.choice(REPLY_TOKEN_ALPHABET) for _ in range(REPLY_TOKEN_LENGTH))
+
+    def reply_prompt(self, token):
+        """Line appended to a reminder asking the recipient to confirm or cancel"""
+        return f"\n\nReply *CONFIRM {token}* to confirm or *CANCEL {token}* to cancel."
+
+    def handle_reply(self, phone_number, text):
+        """Apply a CONFIRM/CANCEL reply to the appointment its token belongs to.
+
+        Returns (appointment_id, status), or None if the reply has no known
+        token or comes from a number the message was not sent to.
+        """
+        match = REPLY_PATTERN.search(text or '')
+        if not match:
+            print(f"📭 Reply from {phone_number} has no CONFIRM/CANCEL token")
+            return None
+        action, token = match.group(1).upper(), match.group(2).upper()
+        
+        conn = self.connect()
+        c = conn.cursor()
+        c.execute('''SELECT deliveries.appointment_id, deliveries.kind, deliveries.phone, appointments.status
+                     FROM deliveries JOIN appointments ON appointments.id = deliveries.appointment_id
+                     WHERE deliveries.token = ?''', (token,))
+        delivery = c.fetchone()
+        conn.close()
+        phone = self.normalize_phone(phone_number)
+        if delivery is None or delivery['phone'] != phone:
+            print(f"📭 Reply token {token} from {phone} does not match a delivered message")
+            return None
+        
+        if delivery['status'] == APPOINTMENT_CANCELLED:
+            # A cancelled appointment stays cancelled; its slot may already be rebooked
+            status = APPOINTMENT_CANCELLED
+        else:
+            status = APPOINTMENT_CANCELLED if action == 'CANCEL' else APPOINTMENT_CONFIRMED
+            self.queue_write('UPDATE appointments SET status = ? WHERE id = ? AND status IS NOT ?',
+                             (status, delivery['appointment_id'], APPOINTMENT_CANCELLED))
+        self.record_delivery(delivery['appointment_id'], f"reply_{delivery['kind']}", phone,
+                             DELIVERY_RECEIVED, None, text)
+        print(f"📬 {action} from {phone} for appointment {delivery['appointment_id']}")
+        return delivery['appointment_id'], status
+
+    def get_blocking_status(self, phone_number):
+        """Permanent failure status of a recipient's latest delivery, or None if they can be messaged"""
+        conn = self.connect()
+        c = conn.cursor()
+        c.execute('SELECT status FROM deliveries WHERE phone = ? ORDER BY id DESC LIMIT 1',
+                  (self.normalize_phone(phone_number),))
+        latest = c.fetchone()
+        conn.close()
+        if latest and latest['status'] in DELIVERY_PERMANENT_STATUSES:
+            return latest['status']
+        return None
+
+    def send_whatsapp_message(self, phone_number, message):
+        """Send message via WhatsApp API, waiting for the result"""
+        result = job_runner.run(self.send_whatsapp_message_async(phone_number, message)).result()
+        self.flush_writes()
+        return result
 
     def send_reminder(self, phone_number, message):
         """Send reminder via WhatsApp"""
+        result = job_runner.run(self.send_reminder_async(phone_number, message)).result()
+        self.flush_writes()
+        return result
+
+    async def send_reminder_async(self, phone_number, message, appointment_id=None, kind='manual', token=None):
+        """Send reminder via WhatsApp without blocking the event loop"""
         print(f"\n" + "="*50)
         print(f"🚀 SENDING REMINDER TO: {phone_number}")
         print("="*50)
         
-        success, result_msg = self.send_whatsapp_message(phone_number, message)
+        success, result_msg = await self.send_whatsapp_message_async(phone_number, message, appointment_id, kind, token)
         
         if success:
             print(f"✅ SUCCESS: {result_msg}")
@@ -346,117 +1224,176 @@ Please confirm your availability. 🏥"""
         
         return success, result_msg
 
-    def check_reminders(self):
-        """Check and send reminders for appointments tomorrow"""
-        print(f"\n🎯 CHECKING REMINDERS - {datetime.datetime.now()}")
+    async def send_scheduled_reminder(self, phone_number, message, appointment_id, kind):
+        """Send a scheduled reminder with a reply token, unless the recipient is failing permanently"""
+        blocking_status = await asyncio.to_thread(self.get_blocking_status, phone_number)
+        if blocking_status:
+            print(f"⏭️ Skipping {phone_number}: last delivery failed permanently ({blocking_status})")
+            # Later polls leave this row alone instead of skipping it again
+            self.queue_write('UPDATE reminder_batches SET last_status = ? WHERE appointment_id = ? AND kind = ?',
+                             (blocking_status, appointment_id, kind))
+            return False, f"Skipped: recipient failing permanently ({blocking_status})"
+        token = self.new_reply_token()
+        return await self.send_reminder_async(phone_number, message + self.reply_prompt(token),
+                                              appointment_id, kind, token)
+
+    async def process_reminder(self, appointment, staged):
+        """Send the staged patient and doctor reminders for one appointment"""
+        appt_id = appointment['id']
+        patient_name = appointment['patient_name'] or 'Unknown'
+        patient_phone = appointment['patient_phone'] or ''
+        doctor_name = appointment['doctor_name'] or 'Unknown'
+        doctor_phone = appointment['doctor_phone'] or ''
         
-        appointments = self.get_tomorrows_appointments()
+        print(f"\n📝 Processing Appointment ID: {appt_id}")
+        print(f"👤 Patient: {patient_name} ({patient_phone})")
+        print(f"👨‍⚕️ Doctor: Dr. {doctor_name} ({doctor_phone})")
+        print(f"🕐 Time: {appointment['appointment_time']} on {appointment['appointment_date']}")
         
-        if not appointments:
-            print("❌ No appointments found for tomorrow")
-            return []
+        # A resumed batch only sends what the interrupted one didn't deliver, and a
+        # failed message waits out its retry backoff
+        row = staged.get('reminder_patient')
+        if row is None:
+            print(f"\n👤 PATIENT REMINDER IS A DUPLICATE")
+            whatsapp_patient_success, whatsapp_patient_msg = True, "Duplicate of another staged message ✅"
+        elif row['last_status'] in DELIVERY_NO_RESEND_STATUSES:
+            print(f"\n👤 PATIENT REMINDER ALREADY DELIVERED")
+            whatsapp_patient_success, whatsapp_patient_msg = True, "Already delivered ✅"
+        elif not row['due']:
+            print(f"\n👤 PATIENT REMINDER NOT DUE")
+            whatsapp_patient_success, whatsapp_patient_msg = False, self.retry_state(row)
+        else:
+            print(f"\n👤 SENDING PATIENT REMINDER...")
+            whatsapp_patient_success, whatsapp_patient_msg = await self.send_scheduled_reminder(
+                row['phone'], row['message'], appt_id, 'reminder_patient')
         
-        results = []
-        conn = sqlite3.connect('appointments.db')
-        c = conn.cursor()
+        row = staged.get('reminder_doctor')
+        if row is None:
+            print(f"\n👨‍⚕️ DOCTOR REMINDER IS A DUPLICATE")
+            whatsapp_doctor_success, whatsapp_doctor_msg = True, "Duplicate of another staged message ✅"
+        elif row['last_status'] in DELIVERY_NO_RESEND_STATUSES:
+            print(f"\n👨‍⚕️ DOCTOR REMINDER ALREADY DELIVERED")
+            whatsapp_doctor_success, whatsapp_doctor_msg = True, "Already delivered ✅"
+        elif not row['due']:
+            print(f"\n👨‍⚕️ DOCTOR REMINDER NOT DUE")
+            whatsapp_doctor_success, whatsapp_doctor_msg = False, self.retry_state(row)
+        else:
+            print(f"\n👨‍⚕️ SENDING DOCTOR REMINDER...")
+            whatsapp_doctor_success, whatsapp_doctor_msg = await self.send_scheduled_reminder(
+                row['phone'], row['message'], appt_id, 'reminder_doctor')
         
-        for appointment in appointments:
-            # Safely extract appointment data
-            appt_data = self.safe_get_appointment_data(appointment)
-            
-            appt_id = appt_data['id']
-            patient_name = appt_data['patient_name']
-            patient_phone = appt_data['patient_phone']
-            doctor_name = appt_data['doctor_name']
-            doctor_phone = appt_data['doctor_phone']
-            appt_date = appt_data['appointment_date']
-            appt_time = appt_data['appointment_time']
-            
-            print(f"\n📝 Processing Appointment ID: {appt_id}")
-            print(f"👤 Patient: {patient_name} ({patient_phone})")
-            print(f"👨‍⚕️ Doctor: Dr. {doctor_name} ({doctor_phone})")
-            print(f"🕐 Time: {appt_time} on {appt_date}")
-            
-            # Format date for better readability
-            formatted_date = datetime.datetime.strptime(appt_date, '%Y-%m-%d').strftime('%B %d, %Y')
-            
-            # Patient reminder message
-            patient_message = f"""💊 *Appointment Reminder*
-
-Hello {patient_name},
-
-This is a friendly reminder about your appointment tomorrow:
-
-*Doctor:* Dr. {doctor_name}
-*Date:* {formatted_date}
-*Time:* {appt_time}
-
-Please bring any relevant medical reports or medications. 🏥"""
-
-            print(f"\n👤 SENDING PATIENT REMINDER...")
-            whatsapp_patient_success, whatsapp_patient_msg = self.send_reminder(patient_phone, patient_message)
-            
-            time.sleep(3)  # Wait 3 seconds between messages
-            
-            # Doctor reminder message
-            doctor_message = f"""💊 *Appointment Reminder*
-
-Hello Dr. {doctor_name},
+        # Mark reminder as sent only if both WhatsApp were successful
+        if whatsapp_patient_success and whatsapp_doctor_success:
+            self.queue_write('UPDATE appointments SET reminder_sent = 1, whatsapp_sent = 1 WHERE id = ?', (appt_id,))
+            print(f"✅ Marked appointment {appt_id} as reminded")
+        elif whatsapp_patient_success or whatsapp_doctor_success:
+            # If only one succeeded, mark as partial
+            self.queue_write('UPDATE appointments SET whatsapp_sent = 1 WHERE id = ?', (appt_id,))
+            print(f"⚠️ Marked appointment {appt_id} as partially reminded")
+        else:
+            print(f"❌ Failed to send reminders for appointment {appt_id}")
+        
+        return ReminderResult(appt_id, patient_name, doctor_name, patient_phone, doctor_phone,
+                              whatsapp_patient_success, whatsapp_patient_msg,
+                              whatsapp_doctor_success, whatsapp_doctor_msg)
 
-Reminder: You have an appointment tomorrow:
+    async def iter_reminders(self, ignore_spread=False, stop=None):
+        """Send due reminders, yielding each ReminderResult as it completes.
 
-*Patient:* {patient_name}
-*Date:* {formatted_date}
-*Time:* {appt_time}
-*Patient Phone:* {patient_phone}
+        SEND_CONCURRENCY workers pull appointments and their precomputed
+        messages from a paged generator, so neither the appointments nor the
+        results are held in memory as a batch. The generator is advanced in a
+        worker thread, so reading the next page does not stall sends.
+        Status writes are committed every few appointments and flushed when the
+        batch ends or is cancelled, so an interrupted batch resumes where it
+        stopped. Once `stop` (the job runner's shutdown event by default) is
+        set, workers finish the appointment in hand and take no more.
+        """
+        stop = stop or job_runner.stopping
+        appointments = self.iter_staged_reminders(ignore_spread=ignore_spread)
+        # One worker at a time advances the generator
+        appointments_lock = asyncio.Lock()
+        queue = asyncio.Queue(maxsize=SEND_CONCURRENCY)
+        
+        async def worker():
+            while not stop.is_set():
+                async with appointments_lock:
+                    item = await asyncio.to_thread(next, appointments, None)
+                if item is None:
+                    break
+                appointment, staged = item
+                result = await self.process_reminder(appointment, staged)
+                await queue.put(result)
+        
+        workers = [asyncio.create_task(worker()) for _ in range(SEND_CONCURRENCY)]
+        
+        async def finish():
+            try:
+                await asyncio.gather(*workers)
+            finally:
+                await queue.put(None)
+        
+        finisher = asyncio.create_task(finish())
+        try:
+            while (result := await queue.get()) is not None:
+                yield result
+            await finisher
+        finally:
+            for task in workers + [finisher]:
+                task.cancel()
+            await asyncio.to_thread(self.flush_writes)
 
-Please confirm your schedule. 🏥"""
+    async def check_reminders_async(self, on_result=None, ignore_spread=False, stop=None):
+        """Send reminders that are due in their recipients' send windows, several at a time.
 
-            print(f"\n👨‍⚕️ SENDING DOCTOR REMINDER...")
-            whatsapp_doctor_success, whatsapp_doctor_msg = self.send_reminder(doctor_phone, doctor_message)
-            
-            # Mark reminder as sent only if both WhatsApp were successful
-            if whatsapp_patient_success and whatsapp_doctor_success:
-                c.execute('UPDATE appointments SET reminder_sent = 1, whatsapp_sent = 1 WHERE id = ?', (appt_id,))
-                print(f"✅ Marked appointment {appt_id} as reminded")
-            elif whatsapp_patient_success or whatsapp_doctor_success:
-                # If only one succeeded, mark as partial
-                c.execute('UPDATE appointments SET whatsapp_sent = 1 WHERE id = ?', (appt_id,))
-                print(f"⚠️ Marked appointment {appt_id} as partially reminded")
-            else:
-                print(f"❌ Failed to send reminders for appointment {appt_id}")
+        The scheduler calls this every few minutes so each timezone's
+        reminders go out spread across its window; a manual run passes
+        ignore_spread to send everything whose window is currently open.
+        Only one run goes at a time; another one raises RuntimeError.
+        """
+        if not self.reminder_run_lock.acquire(blocking=False):
+            raise RuntimeError('A reminder run is already in progress')
+        try:
+            # Normally everything was staged overnight or at booking; stage any stragglers
+            await asyncio.to_thread(self.precompute_reminders)
             
-            results.append({
-                'appointment_id': appt_id,
-                'patient_name': patient_name,
-                'doctor_name': doctor_name,
-                'patient_phone': patient_phone,
-                'doctor_phone': doctor_phone,
-                'whatsapp_patient_success': whatsapp_patient_success,
-                'whatsapp_patient_message': whatsapp_patient_msg,
-                'whatsapp_doctor_success': whatsapp_doctor_success,
-                'whatsapp_doctor_message': whatsapp_doctor_msg,
-                'reminder_sent': whatsapp_patient_success and whatsapp_doctor_success
-            })
+            successful = failed = 0
+            async for result in self.iter_reminders(ignore_spread, stop):
+                if result.reminder_sent:
+                    successful += 1
+                else:
+                    failed += 1
+                if on_result:
+                    on_result(result)
+        finally:
+            self.reminder_run_lock.release()
         
-        conn.commit()
-        conn.close()
+        if successful or failed:
+            print(f"\n📊 REMINDER CHECK COMPLETE - {datetime.datetime.now()}")
+            print(f"✅ Successful: {successful}")
+            print(f"❌ Failed: {failed}")
         
-        print(f"\n📊 REMINDER CHECK COMPLETE")
-        print(f"✅ Successful: {sum(1 for r in results if r['reminder_sent'])}")
-        print(f"❌ Failed: {sum(1 for r in results if not r['reminder_sent'])}")
-        
-        return results
+        return {'processed': successful + failed, 'successful': successful, 'failed': failed}
+
+    def check_reminders(self):
+        """Send reminders that are due now"""
+        return job_runner.run(self.check_reminders_async()).result()
 
-    def send_test_reminder(self, phone_number, message):
-        """Send a test reminder immediately (bypass date check)"""
+    async def send_test_reminder(self, phone_number, message):
+        """Send a test reminder immediately (bypass date check); raises RuntimeError if it fails"""
         print(f"\n🧪 SENDING TEST REMINDER (IMMEDIATE)")
-        return self.send_reminder(phone_number, message)
+        success, result_msg = await self.send_reminder_async(phone_number, message)
+        if not success:
+            raise RuntimeError(result_msg)
+        return result_msg
 
-    def test_whatsapp(self, phone_number, message):
-        """Test WhatsApp function"""
+    async def test_whatsapp(self, phone_number, message):
+        """Test WhatsApp function; raises RuntimeError if the message was not sent"""
         print(f"\n🧪 TESTING WHATSAPP FUNCTION")
-        return self.send_reminder(phone_number, message)
+        success, result_msg = await self.send_reminder_async(phone_number, message)
+        if not success:
+            raise RuntimeError(result_msg)
+        return result_msg
 
     def test_sms(self, phone_number, message):
         """Test SMS function - placeholder since WhatsApp is primary"""
@@ -465,4 +1402,5 @@ Please confirm your schedule. 🏥"""
         return True, "SMS test successful (mocked)"
 
 # Create a global instance
-reminder_system = ReminderSystem()
\ No newline at end of file
+reminder_system = ReminderSystem()
+job_runner.store = reminder_system
\ No newline at end of file
@@ -0,0 +1,51 @@
+# responses.py - Response caching and compression helpers for slow clinic links
+import gzip
+import hashlib
+import os
+import threading
+
+# Responses smaller than this gain little from compression
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', '1024'))
+COMPRESS_LEVEL = int(os.getenv('COMPRESS_LEVEL', '6'))
+COMPRESS_MIMETYPES = ('text/html', 'application/json')
+
+# Fingerprinted static URLs change whenever the file does, so they can be cached for good
+STATIC_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+_fingerprints = {}
+_fingerprints_lock = threading.Lock()
+
+
+def static_fingerprint(static_folder, filename):
+    """Short content hash of a static file, recomputed only when its mtime changes"""
+    path = os.path.join(static_folder, filename)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    with _fingerprints_lock:
+        cached = _fingerprints.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+    with open(path, 'rb') as f:
+        fingerprint = hashlib.sha256(f.read()).hexdigest()[:12]
+    with _fingerprints_lock:
+        _fingerprints[path] = (mtime, fingerprint)
+    return fingerprint
+
+
+def compress_response(response, accept_encodings):
+    """Gzip an HTML or JSON response in place when the client accepts it and it is big enough"""
+    if (response.status_code != 200 or response.direct_passthrough
+            or response.mimetype not in COMPRESS_MIMETYPES
+            or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    if 'gzip' not in accept_encodings:
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=COMPRESS_LEVEL))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response